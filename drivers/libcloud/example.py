@@ -1,6 +1,5 @@
 #!/usr/bin/env python
 
-import time
 import argparse
 
 """ Load driver """
@@ -29,8 +28,8 @@ def main(args):
         #template is always ubuntu
         #full support is expected later...
     
-    #@TODO implement wait
-    time.sleep(10)
+    print("waiting for ips")
+    driver.wait_node(node.name, ips=True)
     
     print("Listing nodes")
     for node_item in driver.list_nodes():
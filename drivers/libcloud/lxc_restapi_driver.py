@@ -6,7 +6,11 @@ LxcRestapi driver
 """
 import uuid
 import json
+import time
+import queue
+from concurrent.futures import ThreadPoolExecutor
 
+from libcloud.utils.py3 import httplib
 from libcloud.common.base import Connection, JsonResponse
 from libcloud.common.base import LoggingConnection, LoggingHTTPConnection, LibcloudHTTPSConnection
 from libcloud.compute.base import NodeImage, NodeSize, Node
@@ -15,18 +19,39 @@ from libcloud.compute.types import Provider, NodeState
 
 Provider.LXCRESTAPI = "LxcRestapi"
 
+class LxcRestapiResponse(JsonResponse):
+    """
+    LxcRestapi response class, 304 Not Modified is a success
+    """
+    def success(self):
+        return self.status == httplib.NOT_MODIFIED or super(LxcRestapiResponse, self).success()
+
 class LxcRestapiConnection(Connection):
     """
     LxcRestapi connection class
+
+    GET requests are conditional: the last response of each url is kept
+    with its ETag and reused when the server answers 304 Not Modified
+
+    The http connection is kept open across requests (keep-alive) when
+    the server allows it
     """
     url = "http://localhost:8080/v1"
-    responseCls = JsonResponse
+    responseCls = LxcRestapiResponse
     conn_classes = (LoggingHTTPConnection, LibcloudHTTPSConnection)
     
     def __init__(self, *args, **kwargs):
         if 'url' not in kwargs:    
             kwargs['url'] = self.url     
         super(LxcRestapiConnection, self).__init__(*args, **kwargs)
+        self.etags = {}
+
+    def connect(self, host=None, port=None, base_url=None):
+        """
+        libcloud connects again before each request: only connect once
+        """
+        if getattr(self, 'connection', None) is None or host is not None or port is not None:
+            super(LxcRestapiConnection, self).connect(host=host, port=port, base_url=base_url)
 
     def request(self, **kwargs):
         if not 'headers' in kwargs:
@@ -34,8 +59,22 @@ class LxcRestapiConnection(Connection):
             
         kwargs['headers'].update(
             {'Content-type': 'application/json', 'Accept': 'application/json'})
-                
-        return super(LxcRestapiConnection, self).request(**kwargs)
+
+        cache_key = None
+        if kwargs.get('method', 'GET') == 'GET' and not kwargs.get('raw'):
+            cache_key = (kwargs.get('action'), json.dumps(kwargs.get('params'), sort_keys=True))
+        cached = self.etags.get(cache_key)
+        if cached is not None:
+            kwargs['headers']['If-None-Match'] = cached[0]
+
+        response = super(LxcRestapiConnection, self).request(**kwargs)
+
+        if cache_key is not None:
+            if response.status == httplib.NOT_MODIFIED and cached is not None:
+                response.body, response.object = cached[1], cached[2]
+            elif 'etag' in response.headers:
+                self.etags[cache_key] = (response.headers['etag'], response.body, response.object)
+        return response
 
 class LxcRestapiNodeDriver(NodeDriver):
     """
@@ -70,16 +109,29 @@ class LxcRestapiNodeDriver(NodeDriver):
       }
     
     
+    #seconds list_images() is served from cache
+    IMAGES_TTL = 60
+    
     def __init__(self, *args, **kwargs ):
         """
         @param  creds: Credentials
         @type   creds: C{str}
 
+        @param  max_workers: nodes fetched at the same time (default: 8)
+        @type   max_workers: C{int}
+
         @rtype: C{None}
         """
         if 'url' in kwargs:
             self.connectionCls.url = kwargs['url']
+        self.max_workers = kwargs.pop('max_workers', 8)
         super(LxcRestapiNodeDriver, self).__init__('n/a', **kwargs)
+        #name -> (ETag, Node)
+        self.nodes = {}
+        #idle connections of the concurrent fetches
+        self.connections = queue.Queue()
+        #(time, images) of the last list_images()
+        self.images = None
     
     def get_uuid(self, unique_field=None):
         """
@@ -92,14 +144,42 @@ class LxcRestapiNodeDriver(NodeDriver):
 
     def list_nodes(self):
         """
+        Built from the listing when the server embeds the ips in it,
+        otherwise each node is fetched, max_workers at a time
+
         @inherits: L{NodeDriver.list_nodes}
         """
-        listing = self.connection.request(action="/v1/containers", method="GET").parse_body()
-        retval = []
-        for node in listing['containers']:
-            retval.append(self.get_node(node['name']))
-        
-        return retval
+        listing = self.connection.request(action="/v1/containers", params={"detail": "ips"},
+                                          method="GET").parse_body()
+        containers = listing['containers']
+        if all('ips' in container for container in containers):
+            images = self.list_images()
+            return [self._to_node(container, images) for container in containers]
+        return self.get_nodes([container['name'] for container in containers])
+
+    def get_nodes(self, names):
+        """
+        Fetches the nodes concurrently, a connection per worker; the
+        images are listed once beforehand on the shared connection
+        @return: list of Node, in the order of names
+        """
+        images = self.list_images()
+
+        def fetch(name):
+            try:
+                connection = self.connections.get_nowait()
+            except queue.Empty:
+                connection = self.connectionCls(url=self.connectionCls.url)
+                connection.driver = self
+                connection.etags = self.connection.etags
+                connection.connect()
+            try:
+                return self.get_node(name, connection=connection, images=images)
+            finally:
+                self.connections.put(connection)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(fetch, names))
 
     def reboot_node(self, node):
         """
@@ -116,37 +196,56 @@ class LxcRestapiNodeDriver(NodeDriver):
         @inherits: L{NodeDriver.destroy_node}
         """
         response = self.connection.request(action="/v1/containers/%s/actions/stop" % node.name, method="POST")
+        self.wait_job(response.parse_body())
         response = self.connection.request(action="/v1/containers/%s" % node.name , method="DELETE")
         if response.success():
             node.state = NodeState.TERMINATED
+            self.nodes.pop(node.name, None)
             return True
         else:
             return False
 
     def list_images(self, location=None):
         """
-        @todo: implement template listing 
-        
+        Templates of the server: a bare image per template and one per
+        cached build (template args), e.g. ubuntu.precise
+
+        Cached for IMAGES_TTL seconds
+
         @inherits: L{NodeDriver.list_images}
         """
-        return [
-                NodeImage(id="ubuntu.lucid", 
-                          name="ubuntu.lucid", 
-                          extra={"template_name":"ubuntu",
-                                  "template_args":[{"key":"release","val":"lucid"}]},
-                          driver=self),
-                NodeImage(id="ubuntu.precise",
-                          name="ubuntu.precise",
-                          extra={"template_name":"ubuntu",
-                                  "template_args":[{"key":"release","val":"precise"}]},
-                          driver=self)
-        ]
+        if self.images is not None and time.time() - self.images[0] < self.IMAGES_TTL:
+            return list(self.images[1])
+        try:
+            templates = self.connection.request(action="/v1/templates", method="GET").parse_body()['templates']
+        except Exception:
+            templates = []
+        if not templates:
+            #server without /templates, or without templates nor cached builds
+            templates = [{"name": "ubuntu",
+                          "cached": [{"release": "lucid"}, {"release": "precise"}]}]
+        retval = []
+        for template in templates:
+            retval.append(NodeImage(id=template['name'],
+                                    name=template['name'],
+                                    extra={"template_name": template['name'],
+                                           "template_args": []},
+                                    driver=self))
+            for args in template['cached']:
+                name = ".".join([template['name']] + [str(args[key]) for key in sorted(args)])
+                retval.append(NodeImage(id=name,
+                                        name=name,
+                                        extra={"template_name": template['name'],
+                                               "template_args": [{"key": key, "val": args[key]}
+                                                                 for key in sorted(args)]},
+                                        driver=self))
+        self.images = (time.time(), retval)
+        return list(retval)
 
     def list_sizes(self, location=None):
         """
-        @todo: implement with cgroup 
-        
-        Returns a list of node sizes as a cloud provider might have
+        Returns a list of node sizes as a cloud provider might have, the
+        ram of a size is the memory cgroup limit of its nodes
         @inherits: L{NodeDriver.list_images}
         """
 
@@ -186,26 +285,96 @@ class LxcRestapiNodeDriver(NodeDriver):
                             "args":image.extra["template_args"]
                             }
        
+        cgroups = []
+        if kwargs.get('size') is not None:
+            cgroups.append({"key": "memory.limit_in_bytes",
+                            "val": str(kwargs['size'].ram * 1024 * 1024)})
+
         name = kwargs['name']
         container = {
-                     "cgroups": [],
+                     "cgroups": cgroups,
                      "name": name,
                      "conf": [],
                      "template": template
                      }
         
-        self.connection.request(action="/v1/containers", method="POST", data=json.dumps(container))
+        response = self.connection.request(action="/v1/containers", method="POST", data=json.dumps(container))
+        self.wait_job(response.parse_body())
         self.connection.request(action="/v1/containers/%s/actions/start" % name, method="POST")
+        self.wait_node(name)
         return self.get_node(name)
+
+    def node_stats(self, node=None):
+        """
+        cpu, memory and block I/O usage of a node, of all the running
+        nodes when node is None
+        @return: stats dict, list of them for all the nodes
+        """
+        if node is not None:
+            return self.connection.request(action="/v1/containers/%s/stats" % node.name,
+                                           method="GET").parse_body()
+        return self.connection.request(action="/v1/stats", method="GET").parse_body()['stats']
+
+    def wait_node(self, name, state="RUNNING", ips=False, timeout=60):
+        """
+        Waits on the server side until the container is in state (and has ips)
+
+        The server may wait less than asked (single threaded server): the
+        wait is requested again until timeout
+        @return: True if reached before timeout
+        """
+        deadline = time.time() + timeout
+        while True:
+            response = self.connection.request(
+                            action="/v1/containers/%s/wait" % name,
+                            params={"state": state, "ips": int(ips),
+                                    "timeout": max(0, deadline - time.time())},
+                            method="GET")
+            reached = response.parse_body()['reached']
+            if reached or time.time() >= deadline:
+                return reached
+
+    def wait_job(self, job, timeout=600, interval=1):
+        """
+        Follows a job returned by a 202 response until it is finished
+        @return: the finished job
+        """
+        while job['status'] in ('queued', 'running') and timeout > 0:
+            time.sleep(interval)
+            timeout -= interval
+            job = self.connection.request(action="/v1/jobs/%s" % job['id'], method="GET").parse_body()
+        return job
     
-    def get_node(self, name):
+    def get_node(self, name, connection=None, images=None):
         """
         Converts a json container data from rest webservice to node format
+
+        The node built last time is returned while the container ETag
+        doesn't change
         @return: Node
         """
-        response = self.connection.request(action="/v1/containers/%s" % name, method="GET")
-        container = response.parse_body()
-        
+        connection = connection or self.connection
+        response = connection.request(action="/v1/containers/%s" % name, method="GET")
+        etag = response.headers.get('etag')
+        if etag is not None and name in self.nodes and self.nodes[name][0] == etag:
+            return self.nodes[name][1]
+        node = self._to_node(response.parse_body(), images)
+        if etag is not None:
+            self.nodes[name] = (etag, node)
+        return node
+
+    def _to_node(self, container, images=None):
+        """
+        Node of a container of the listing or of its details, its image is
+        the one of its template when the server knows it (images: the
+        list_images() to pick it from)
+        """
+        images = images or self.list_images()
+        image = images[0]
+        for candidate in images:
+            if candidate.name == container.get('template'):
+                image = candidate
+                break
         try:
             state = self.NODE_STATE_MAP[container['state']]
         except KeyError:
@@ -217,7 +386,7 @@ class LxcRestapiNodeDriver(NodeDriver):
                      public_ips=container['ips'],
                      private_ips=[],
                      driver=self,
-                     image=self.list_images()[0])
+                     image=image)
     
 if __name__ == "__main__":
     import doctest
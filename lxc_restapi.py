@@ -3,26 +3,190 @@
 import subprocess
 import shlex
 import argparse
+import base64
+import codecs
+import os
+import fnmatch
+import hashlib
+import threading
+import time
+import uuid
+import json
+import math
+import mimetypes
+import zlib
+import queue
+import re
+import sqlite3
+from contextlib import contextmanager
+from email.utils import formatdate
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler
 
-from bottle import route, run, request, abort, static_file
+from bottle import route, run, request, response, abort, static_file, HTTPError
+from bottle import ServerAdapter, HTTPResponse, install, default_app
 
 import lxc
 
 # Conf
 # available actions by state
-ACTIONS_BY_STATE = {"STOPPED": ['start', 'destroy'],
+ACTIONS_BY_STATE = {"STOPPED": ['start', 'destroy', 'clone'],
       "STARTING": [],
-      "RUNNING": ['shutdown', 'freeze'],
+      "RUNNING": ['shutdown', 'stop', 'restart', 'freeze'],
       "STOPPING": [],
       "ABORTING": [],
       "FREEZING": [],
-      "FROZEN": ['unfreeze'],
+      "FROZEN": ['unfreeze', 'stop'],
       "THAWED": []}
 
 LXC_MIN_VERSION = "0.9.0"
 
 DEFAULT_TEMPLATE = "ubuntu"
 
+#fields of the container details, ?fields= selects some of them
+CONTAINER_FIELDS = ['name', 'state', 'init_pid', 'conf', 'ips', 'actions']
+
+#keys of the containers listing ?sort= (template and created with --index)
+LISTING_SORT_KEYS = ['name', 'state', 'init_pid', 'template', 'created']
+#types of their values, in the cursors of the pages
+LISTING_SORT_TYPES = {'name': str, 'state': str, 'init_pid': int, 'template': str, 'created': (int, float)}
+
+#parts the containers listing embeds on ?detail=
+LISTING_DETAILS = ['ips', 'conf_hash', 'actions']
+
+#golden pool: create requests clone a pre-created base container per
+#template and args instead of running the template
+GOLDEN_POOL = False
+GOLDEN_PREFIX = "golden-"
+
+#backing store of the clones made from the golden pool
+GOLDEN_BDEVTYPE = "overlayfs"
+
+#bytes of disk the golden pool bases may use, least recently used are evicted
+TEMPLATE_CACHE_SIZE = 10 * 1024 ** 3
+
+LXC_TEMPLATES_DIR = "/usr/share/lxc/templates"
+
+#workers shared by the jobs of the actions without a concurrency limit
+#(stop, restart, ...), a limited action has a pool of its own
+JOB_WORKERS = 4
+
+#number of finished jobs kept for /jobs
+JOB_HISTORY = 100
+
+#per action: (max running at once, requests per second, burst), None for no limit
+#the jobs of an action with a concurrency limit run in a pool of that size
+ACTION_LIMITS = {'create': (4, None, None),
+                 'clone': (4, None, None),
+                 'golden': (4, None, None),
+                 'start': (20, None, None)}
+
+#jobs of an action with a concurrency limit waiting to run before 429
+ACTION_QUEUE_SIZE = 100
+
+#number of containers handled in parallel by a bulk action
+BULK_WORKERS = 8
+
+#seconds the state snapshot of the containers listing is served from cache
+SNAPSHOT_TTL = 2.0
+
+#number of containers read in parallel to take a snapshot
+SNAPSHOT_WORKERS = 8
+
+#seconds to wait for a busy container before reusing its previous state
+SNAPSHOT_LOCK_TIMEOUT = 0.1
+
+#seconds get_ips() may wait for the ips of a container during a refresh,
+#and max seconds before a running container missing in the ips index is probed again
+IPS_PROBE_TIMEOUT = 1
+IPS_PROBE_BACKOFF = 60
+
+#the background refresh pauses when no client read the states for this many TTLs
+SNAPSHOT_IDLE_TTLS = 5
+
+#sqlite file indexing the containers across restarts (--index), None: no index
+INDEX_PATH = None
+
+#dnsmasq lease files (lxc-net's) and neighbour table giving the ips of the
+#containers by mac address, without entering their network namespace
+DHCP_LEASES = ['/var/lib/misc/dnsmasq.lxcbr0.leases']
+ARP_TABLE = '/proc/net/arp'
+
+#number of container events kept for /events
+EVENT_HISTORY = 1000
+
+#max seconds a /events request waits for new events
+EVENT_TIMEOUT = 30
+
+#max seconds a /wait request waits for its condition
+WAIT_MAX_TIMEOUT = 600
+
+#max seconds a /wait or /events request blocks with the single threaded
+#server, which serves nothing else meanwhile: clients call again
+WAIT_SINGLE_THREADED_TIMEOUT = 2
+SINGLE_THREADED = False
+
+#upper bounds in seconds of the latency histograms of /metrics
+METRICS_BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300]
+
+#number of exec sessions streaming at the same time
+EXEC_MAX = 8
+
+#bytes read at once from the output of an exec
+EXEC_CHUNK = 65536
+
+#exec sessions (shells kept attached) per container
+SESSIONS_PER_CONTAINER = 4
+
+#bytes of stdout and of stderr an exec session command keeps, the last ones
+SESSION_OUTPUT_MAX = 1024 ** 2
+
+#seconds of inactivity before an exec session is closed
+SESSION_IDLE_TIMEOUT = 300
+
+#conf keys of the cgroup items applied when a container starts
+CGROUP_CONF_PREFIX = "lxc.cgroup."
+
+#admission control of starts and creates against the host budgets
+ADMISSION = False
+
+#actions committing the cgroup limits of the container, admitted like starts
+ADMITTED_ACTIONS = ('start', 'restart', 'unfreeze')
+
+#host budgets: bytes of memory and cpus (None: the host's), disk bytes kept free
+ADMISSION_MEMORY = None
+ADMISSION_CPUS = None
+ADMISSION_DISK_RESERVE = 1024 ** 3
+
+#committed by a container without memory/cpu limit, and disk taken by a create;
+#a container without cpu limit shares the cpus, it commits none by default
+ADMISSION_DEFAULT_MEMORY = 256 * 1024 ** 2
+ADMISSION_DEFAULT_CPUS = 0
+ADMISSION_CREATE_DISK = 1024 ** 3
+
+#jobs waiting for room before 503, seconds they wait before failing
+ADMISSION_QUEUE_SIZE = 100
+ADMISSION_TIMEOUT = 300
+ADMISSION_RETRY_AFTER = 5
+
+#http server backends: --server choices
+SERVERS = ['wsgiref', 'threaded', 'paste', 'cherrypy', 'waitress']
+
+#number of threads serving requests with a multi-threaded backend
+SERVER_WORKERS = 16
+
+#json encoders of the responses, the first installed one is used by default
+JSON_ENCODERS = ['orjson', 'ujson', 'json']
+
+#responses larger than this are gzip or deflate encoded if Accept-Encoding allows it
+COMPRESS_MIN_SIZE = 1024
+COMPRESS_LEVEL = 6
+
+#seconds browsers may cache the swagger ui files without asking again
+STATIC_MAX_AGE = 86400
+
 def is_good_lxc_version(version):
     #Check LXC version
     retval = True
@@ -41,29 +205,890 @@ PREFIX = "/v1"
 
 #Common
 CONTAINERS = {}
+CONTAINERS_LOCK = threading.Lock()
+CONTAINER_LOCKS = {}
+
+#Metrics, name -> {labels: counter or histogram}
+METRICS_HELP = {
+    'lxc_restapi_requests_total':
+        ('counter', 'HTTP requests by route, method and status'),
+    'lxc_restapi_request_duration_seconds':
+        ('histogram', 'HTTP requests handling time by route and method'),
+    'lxc_restapi_jobs_total':
+        ('counter', 'Finished jobs by action and status'),
+    'lxc_restapi_job_duration_seconds':
+        ('histogram', 'Jobs running time by action'),
+    'lxc_restapi_lxc_call_duration_seconds':
+        ('histogram', 'liblxc calls and property reads by call'),
+    'lxc_restapi_snapshot_refresh_failures_total':
+        ('counter', 'Background refreshes of the state snapshot which failed'),
+    'lxc_restapi_limited_total':
+        ('counter', 'Requests refused with 429 by action and limit'),
+    'lxc_restapi_admission_rejected_total':
+        ('counter', 'Starts and creates refused for lack of room on the host by action'),
+    'lxc_restapi_ip_lookups_total':
+        ('counter', 'Container ips lookups by source: index, cache of a probe or get_ips probe'),
+}
+METRICS = dict((name, {}) for name in METRICS_HELP)
+METRICS_LOCK = threading.Lock()
+
+#Parsed configurations, name -> {conf, mtime, etag, version}
+CONFIGS = {}
+
+#ips by mac address read from DHCP_LEASES and ARP_TABLE, path -> (mtime, {mac: [ip]})
+IP_SOURCES = {}
+IP_INDEX = {}
+IP_INDEX_LOCK = threading.Lock()
+#mac addresses of the containers, name -> (conf etag, [mac])
+HWADDRS = {}
+#last get_ips() of the running containers, name -> (init_pid, ips, retry time, delay)
+PROBED_IPS = {}
+
+#cgroup hierarchies, controller -> mount point ("" for cgroup2), read once
+CGROUP_MOUNTS = None
+
+#admission control: reservations of the admitted jobs, jobs waiting for room
+ADMISSION_LOCK = threading.Lock()
+ADMISSION_RESERVATIONS = []
+ADMISSION_QUEUE = deque()
+#memory and cpu committed by the running containers of a snapshot
+COMMITTED = {'snapshot': None, 'resources': None}
+
+#Exec sessions slots
+EXEC_SLOTS = threading.BoundedSemaphore(EXEC_MAX)
+
+#Exec sessions, id -> ExecSession
+SESSIONS = {}
+SESSIONS_LOCK = threading.Lock()
+#sessions being spawned, name -> count, they take a slot of their container
+SESSIONS_STARTING = {}
+
+#Jobs
+JOBS = OrderedDict()
+JOBS_LOCK = threading.Lock()
+JOB_EXECUTOR = None
+#action -> ActionLimit
+LIMITS = {}
+LIMITS_LOCK = threading.Lock()
+
+#Golden pool, base container name -> cache entry
+GOLDEN = {}
+GOLDEN_LOCK = threading.Lock()
+
+#State snapshot of the containers
+SNAPSHOT = {'containers': [], 'ips': {}, 'time': 0, 'generation': -1, 'etag': None}
+SNAPSHOT_LOCK = threading.Lock()
+SNAPSHOT_REFRESH_LOCK = threading.Lock()
+SNAPSHOT_WAKEUP = threading.Event()
+SNAPSHOT_INVALIDATIONS = 0
+SNAPSHOT_EXECUTOR = None
+#last time a client read the snapshot or the events
+SNAPSHOT_READ = 0
+
+#containers index (sqlite connection), name -> {template, created} of its rows
+INDEX = None
+INDEX_LOCK = threading.Lock()
+INDEX_META = {}
+#conf hashes found by reads of the configs, name -> hash, written by the next index_snapshot()
+INDEX_PENDING = {}
+
+#swagger main doc serialized once without its basePath, which follows the
+#Host of each request
+SWAGGER_MAIN_BODY = json.dumps({'apiVersion': "0.1",
+                                'swaggerVersion': "1.1",
+                                'apis': [
+                                  {
+                                    'path': "/api-docs.json/containers",
+                                    'description': "LXC containers management",
+                                  }
+                                ]})
+#swagger ui files read into memory (--preload-static), path -> asset
+STATIC_ASSETS = {}
+
+#Events produced by the snapshots
+EVENTS = deque(maxlen=EVENT_HISTORY)
+EVENTS_CONDITION = threading.Condition()
+EVENT_ID = 0
+EVENT_WAITERS = 0
 
 
 @route(PREFIX + "/api-docs.json", method='GET')
 def get_swagger():
     """ Get swagger Main json """
     url = request.urlparts
-    retval = {'apiVersion': "0.1",
-              'swaggerVersion': "1.1",
-              'basePath': "%s://%s%s" % (url.scheme, url.netloc, PREFIX),
-              'apis': [
-                {
-                  'path': "/api-docs.json/containers",
-                  'description': "LXC containers management",
-                }
-              ]}
-    return retval
+    base_path = "%s://%s%s" % (url.scheme, url.netloc, PREFIX)
+    body = '{"basePath": %s, %s' % (json.dumps(base_path), SWAGGER_MAIN_BODY[1:])
+    return cached_json(body, '"%s"' % hashlib.sha1(body.encode('utf-8')).hexdigest())
+
+
+def cached_json(body, etag):
+    """ Serialized json body, 304 if If-None-Match lists its etag
+
+    Clients must revalidate it: the docs change with the server
+    """
+    response.set_header('Cache-Control', 'no-cache')
+    if not_modified(etag):
+        return ''
+    response.content_type = 'application/json'
+    return body
+
+
+def inc_metric(metric, labels):
+    """ Increment a counter, labels is a tuple of (label, value) """
+    with METRICS_LOCK:
+        METRICS[metric][labels] = METRICS[metric].get(labels, 0) + 1
+
+
+def observe_metric(metric, labels, seconds):
+    """ Record a duration in a histogram, labels is a tuple of (label, value) """
+    with METRICS_LOCK:
+        if labels not in METRICS[metric]:
+            METRICS[metric][labels] = {'buckets': [0] * len(METRICS_BUCKETS),
+                                       'sum': 0.0,
+                                       'count': 0}
+        histogram = METRICS[metric][labels]
+        for i, bound in enumerate(METRICS_BUCKETS):
+            if seconds <= bound:
+                histogram['buckets'][i] += 1
+        histogram['sum'] += seconds
+        histogram['count'] += 1
+
+
+def metrics_text():
+    """ All the metrics in prometheus text format """
+    def labels_text(labels):
+        if not labels:
+            return ""
+        return "{%s}" % ",".join('%s="%s"' % (key, str(val).replace('\\', '\\\\')
+                                                           .replace('"', '\\"')
+                                                           .replace('\n', '\\n'))
+                                 for key, val in labels)
+    lines = []
+    with METRICS_LOCK:
+        for metric in sorted(METRICS):
+            metric_type, metric_help = METRICS_HELP[metric]
+            lines.append("# HELP %s %s" % (metric, metric_help))
+            lines.append("# TYPE %s %s" % (metric, metric_type))
+            for labels, value in sorted(METRICS[metric].items()):
+                if metric_type == 'counter':
+                    lines.append("%s%s %s" % (metric, labels_text(labels), value))
+                    continue
+                for bound, count in zip(METRICS_BUCKETS, value['buckets']):
+                    lines.append("%s_bucket%s %s" % (metric, labels_text(labels + (('le', bound), )), count))
+                lines.append("%s_bucket%s %s" % (metric, labels_text(labels + (('le', '+Inf'), )), value['count']))
+                lines.append("%s_sum%s %s" % (metric, labels_text(labels), value['sum']))
+                lines.append("%s_count%s %s" % (metric, labels_text(labels), value['count']))
+    return "\n".join(lines) + "\n"
+
+
+class TimedContainer(object):
+    """ lxc.Container proxy timing the liblxc calls and property reads """
+
+    def __init__(self, container):
+        self.__dict__['container'] = container
+
+    def __getattr__(self, attr):
+        started = time.time()
+        value = getattr(self.container, attr)
+        if not callable(value):
+            observe_metric('lxc_restapi_lxc_call_duration_seconds',
+                           (('call', attr), ), time.time() - started)
+            return value
+
+        def timed(*args, **kwargs):
+            started = time.time()
+            try:
+                return value(*args, **kwargs)
+            finally:
+                observe_metric('lxc_restapi_lxc_call_duration_seconds',
+                               (('call', attr), ), time.time() - started)
+        return timed
+
+    def __setattr__(self, attr, value):
+        setattr(self.container, attr, value)
+
+
+class MetricsPlugin(object):
+    """ Bottle plugin counting and timing the requests of every route """
+    name = 'metrics'
+    api = 2
+
+    def apply(self, callback, route):
+        labels = (('route', route.rule), ('method', route.method))
+
+        def wrapper(*args, **kwargs):
+            started = time.time()
+            status = 500
+            try:
+                retval = callback(*args, **kwargs)
+                #static_file() returns its own response, 304 or 404
+                status = retval.status_code if isinstance(retval, HTTPResponse) else response.status_code
+                return retval
+            except HTTPResponse as e:
+                status = e.status_code
+                raise
+            finally:
+                observe_metric('lxc_restapi_request_duration_seconds', labels,
+                               time.time() - started)
+                inc_metric('lxc_restapi_requests_total', labels + (('status', status), ))
+        return wrapper
+
+
+def json_encoder(name):
+    """ dumps function of a json encoder, None if it isn't installed """
+    try:
+        module = __import__(name)
+    except ImportError:
+        return None
+    if name == 'orjson':
+        return lambda data: module.dumps(data, option=module.OPT_NON_STR_KEYS).decode('utf-8')
+    return module.dumps
+
+JSON_DUMPS = [dumps for dumps in map(json_encoder, JSON_ENCODERS) if dumps is not None][0]
+
+
+def accepted_encoding():
+    """ gzip or deflate if the request Accept-Encoding allows it, else None """
+    accepted = {}
+    for item in request.get_header('Accept-Encoding', '').split(','):
+        coding, sep, q = item.partition(';')
+        try:
+            accepted[coding.strip().lower()] = float(q.strip()[2:]) if q.strip().startswith('q=') else 1
+        except ValueError:
+            pass
+    for coding in ('gzip', 'deflate'):
+        if accepted.get(coding, accepted.get('*', 0)) > 0:
+            return coding
+    return None
+
+
+def compress_body(body):
+    """ body encoded with the accepted coding if it is large enough
+
+    Vary is set whatever the size: a cache must not serve a small or a
+    304 response to a client asking another coding
+    """
+    if isinstance(body, str):
+        body = body.encode(response.charset or 'utf-8')
+    response.set_header('Vary', 'Accept-Encoding')
+    if len(body) < COMPRESS_MIN_SIZE or 'Content-Encoding' in response.headers:
+        return body
+    coding = accepted_encoding()
+    if coding is None:
+        return body
+    #gzip: gzip header and trailer, deflate: zlib ones
+    compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, 31 if coding == 'gzip' else 15)
+    response.set_header('Content-Encoding', coding)
+    etag = response.headers.get('ETag')
+    if etag is not None and not etag.startswith('W/'):
+        #other bytes than the identity body
+        response.set_header('ETag', 'W/' + etag)
+    return compressor.compress(body) + compressor.flush()
+
+
+class EncoderPlugin(object):
+    """ Bottle plugin replacing its json one: dicts are encoded with
+    JSON_DUMPS, then large text bodies are compressed
+    """
+    name = 'json'
+    api = 2
+
+    def apply(self, callback, route):
+
+        def wrapper(*args, **kwargs):
+            retval = callback(*args, **kwargs)
+            if isinstance(retval, dict):
+                response.content_type = 'application/json'
+                retval = JSON_DUMPS(retval)
+            if isinstance(retval, (str, bytes)) and not response.content_type.startswith('image/'):
+                retval = compress_body(retval)
+            return retval
+        return wrapper
+
+
+def list_containers():
+    """ lxc.list_containers(), timed """
+    started = time.time()
+    try:
+        return lxc.list_containers()
+    finally:
+        observe_metric('lxc_restapi_lxc_call_duration_seconds',
+                       (('call', 'list_containers'), ), time.time() - started)
 
 
 def get_container_object(name):
     """ Container objects store """
-    if not name in CONTAINERS:
-        CONTAINERS[name] = lxc.Container(name)
-    return CONTAINERS[name]
+    with CONTAINERS_LOCK:
+        if not name in CONTAINERS:
+            CONTAINERS[name] = TimedContainer(lxc.Container(name))
+        return CONTAINERS[name]
+
+
+def container_lock(name):
+    """ Lock serializing the calls on one container
+
+    Calls on different containers run in parallel, reentrant so that
+    restart can chain shutdown, stop and start
+    """
+    with CONTAINERS_LOCK:
+        if not name in CONTAINER_LOCKS:
+            CONTAINER_LOCKS[name] = threading.RLock()
+        return CONTAINER_LOCKS[name]
+
+
+def get_job_executor(action=None):
+    """ Worker pool running the jobs of action, created on first use
+
+    An action with a concurrency limit has a pool of its own, of the
+    size of its limit, so that it can't take all the shared workers
+    """
+    global JOB_EXECUTOR
+    limit = action_limit(action) if action is not None else None
+    with JOBS_LOCK:
+        if limit is not None and limit.concurrency:
+            if limit.executor is None:
+                limit.executor = ThreadPoolExecutor(max_workers=limit.concurrency)
+            return limit.executor
+        if JOB_EXECUTOR is None:
+            JOB_EXECUTOR = ThreadPoolExecutor(max_workers=JOB_WORKERS)
+    return JOB_EXECUTOR
+
+
+class ActionLimit(object):
+    """ Concurrency limit and token bucket of an action
+
+    Jobs wait in the queue of their pool; synchronous actions are refused
+    when all the slots are taken
+    """
+    def __init__(self, action, concurrency=None, rate=None, burst=None):
+        self.action = action
+        self.concurrency = concurrency
+        self.rate = rate
+        self.burst = burst or (max(1, rate) if rate else None)
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.running = 0
+        self.waiting = 0
+        self.rejected = 0
+        #moving average of the running times, for Retry-After
+        self.duration = None
+        self.condition = threading.Condition()
+        self.executor = None
+
+    def view(self):
+        with self.condition:
+            return {'action': self.action,
+                    'concurrency': self.concurrency,
+                    'rate': self.rate,
+                    'burst': self.burst,
+                    'tokens': self.tokens,
+                    'running': self.running,
+                    'waiting': self.waiting,
+                    'rejected': self.rejected,
+                    'duration': self.duration}
+
+    def reject(self, reason, seconds):
+        """ 429, self.condition held """
+        self.rejected += 1
+        inc_metric('lxc_restapi_limited_total', (('action', self.action), ('limit', reason)))
+        abort_retry(429, 'Too many %s requests (%s limit)' % (self.action, reason),
+                    max(1, int(math.ceil(seconds))))
+
+    def admit(self, queue=True):
+        """ Take a token, and room in the queue for a job, 429 otherwise
+
+        Without queue, a running slot must be free
+        """
+        with self.condition:
+            if self.rate:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens < 1:
+                    self.reject('rate', (1 - self.tokens) / self.rate)
+            if self.concurrency:
+                backlog = (self.duration or 1) * (self.waiting + 1) / self.concurrency
+                if queue and self.waiting >= ACTION_QUEUE_SIZE:
+                    self.reject('queue', backlog)
+                if not queue and self.running >= self.concurrency:
+                    self.reject('concurrency', backlog)
+            if self.rate:
+                self.tokens -= 1
+            if queue:
+                self.waiting += 1
+
+    def wait_token(self):
+        """ Take a token, waiting for the bucket to refill if it is empty """
+        while self.rate:
+            with self.condition:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def cancel(self):
+        """ An admitted job won't run """
+        with self.condition:
+            self.waiting -= 1
+
+    def start(self, queued=True):
+        """ Wait for a running slot, returns the start time """
+        with self.condition:
+            if queued:
+                self.waiting -= 1
+            while self.concurrency and self.running >= self.concurrency:
+                self.condition.wait()
+            self.running += 1
+        return time.time()
+
+    def finish(self, started):
+        """ Give back the running slot taken at started """
+        duration = time.time() - started
+        with self.condition:
+            self.running -= 1
+            if self.duration is None:
+                self.duration = duration
+            else:
+                self.duration = 0.8 * self.duration + 0.2 * duration
+            self.condition.notify()
+
+    @contextmanager
+    def slot(self):
+        """ Running slot of a synchronous action, 429 if none is free """
+        self.admit(queue=False)
+        started = self.start(queued=False)
+        try:
+            yield
+        finally:
+            self.finish(started)
+
+
+def action_limit(action):
+    """ ActionLimit of an action, created on first use """
+    with LIMITS_LOCK:
+        if action not in LIMITS:
+            LIMITS[action] = ActionLimit(action, *ACTION_LIMITS.get(action, (None, None, None)))
+        return LIMITS[action]
+
+
+def job_view(job):
+    """ Copy of a job safe to serialize while a worker updates it """
+    with JOBS_LOCK:
+        return dict(job)
+
+
+def prune_jobs():
+    """ Forget the oldest finished jobs above JOB_HISTORY, JOBS_LOCK held """
+    finished = [job_id for job_id, job in JOBS.items()
+                if job['status'] in ('done', 'failed')]
+    for job_id in finished[:max(0, len(finished) - JOB_HISTORY)]:
+        del JOBS[job_id]
+
+
+def abort_retry(code, text, seconds):
+    """ abort() with a Retry-After header
+
+    bottle 0.11 keeps the headers of the response, later versions send
+    the ones of the error
+    """
+    response.set_header('Retry-After', str(seconds))
+    error = HTTPError(code, text)
+    if hasattr(error, 'set_header'):
+        error.set_header('Retry-After', str(seconds))
+    raise error
+
+
+def error_message(e):
+    """ Message of an abort() or of an unexpected exception """
+    if isinstance(e, HTTPError):
+        return e.body
+    return "%s: %s" % (e.__class__.__name__, e)
+
+
+def run_job(job, func, args):
+    """ Job body, executed by a worker of the pool """
+    limit = action_limit(job['action'])
+    started = limit.start()
+    with JOBS_LOCK:
+        job['status'] = 'running'
+        job['started'] = time.time()
+    status, result, error = 'done', None, None
+    try:
+        result = func(*args)
+    except Exception as e:
+        status, error = 'failed', error_message(e)
+    finally:
+        limit.finish(started)
+    invalidate_snapshot()
+    with JOBS_LOCK:
+        job['status'] = status
+        job['result'] = result
+        job['error'] = error
+        job['finished'] = time.time()
+        job['duration'] = job['finished'] - job['started']
+        prune_jobs()
+    observe_metric('lxc_restapi_job_duration_seconds', (('action', job['action']), ),
+                   job['duration'])
+    inc_metric('lxc_restapi_jobs_total', (('action', job['action']), ('status', status)))
+
+
+def new_job(action, name):
+    """ Register a queued job """
+    job = {'id': str(uuid.uuid4()),
+           'action': action,
+           'container': name,
+           'status': 'queued',
+           'created': time.time(),
+           'started': None,
+           'finished': None,
+           'duration': None,
+           'result': None,
+           'error': None}
+    with JOBS_LOCK:
+        JOBS[job['id']] = job
+    return job
+
+
+def submit_job(action, name, func, *args):
+    """ Queue func(*args) on the worker pool, returns the job
+
+    429 if the limits of action are reached
+    """
+    action_limit(action).admit()
+    job = new_job(action, name)
+    get_job_executor(action).submit(run_job, job, func, args)
+    return job
+
+
+def job_accepted(job):
+    """ 202 response pointing to the job resource """
+    response.status = 202
+    response.set_header('Location', "%s/jobs/%s" % (PREFIX, job['id']))
+    return job_view(job)
+
+
+def get_snapshot_executor():
+    """ Thread pool reading the containers states, created on first use """
+    global SNAPSHOT_EXECUTOR
+    with SNAPSHOT_LOCK:
+        if SNAPSHOT_EXECUTOR is None:
+            SNAPSHOT_EXECUTOR = ThreadPoolExecutor(max_workers=SNAPSHOT_WORKERS)
+    return SNAPSHOT_EXECUTOR
+
+
+def read_container_state(name, previous, previous_ips):
+    """ (state and init_pid, ips) of a container, previous ones if it is busy
+
+    A busy container which wasn't in the previous snapshot has its state
+    read without its lock. ips are only read for a running container,
+    in the ips index, then by probe_ips()
+    """
+    lock = container_lock(name)
+    if not lock.acquire(timeout=SNAPSHOT_LOCK_TIMEOUT):
+        if name in previous:
+            return previous[name], previous_ips.get(name, [])
+        c = get_container_object(name)
+        entry = {"name": name, "state": c.state, "init_pid": c.init_pid}
+        if INDEX is not None:
+            entry.update(INDEX_META.get(name, {"template": None, "created": None}))
+        return entry, []
+    try:
+        c = get_container_object(name)
+        entry = {"name": name, "state": c.state, "init_pid": c.init_pid}
+        if INDEX is not None:
+            entry.update(INDEX_META.get(name, {"template": None, "created": None}))
+        ips, probe = [], False
+        if entry['state'] == "RUNNING":
+            ips = lookup_ips(name, c, entry['state'], probe=False)
+            probe = not ips
+    finally:
+        lock.release()
+    if probe:
+        #without the lock: entering the network namespace may be slow
+        ips = probe_ips(name, c, entry['init_pid'])
+    return entry, ips
+
+
+def read_states(names, snapshot, started):
+    """ Snapshot of the containers names, taken at started
+
+    The busy containers keep their state of snapshot
+    """
+    previous = dict((item['name'], item) for item in snapshot['containers'])
+    states = list(get_snapshot_executor().map(
+                    lambda name: read_container_state(name, previous, snapshot['ips']),
+                    names))
+    containers = [entry for entry, ips in states]
+    return {'containers': containers,
+            'ips': dict((entry['name'], ips) for entry, ips in states if ips),
+            'time': started,
+            'generation': None,
+            'etag': 'W/' + json_etag(containers)}
+
+
+def refresh_snapshot(since):
+    """ Take a new snapshot unless the current one was taken after since
+
+    Concurrent callers wait for the same refresh instead of each reading
+    all the containers
+    """
+    global SNAPSHOT
+    with SNAPSHOT_REFRESH_LOCK:
+        with SNAPSHOT_LOCK:
+            snapshot = SNAPSHOT
+            generation = SNAPSHOT_INVALIDATIONS
+        if snapshot['generation'] == generation and snapshot['time'] >= since:
+            return snapshot
+        started = time.time()
+        refresh_ip_index()
+        new_snapshot = read_states(list_containers(), snapshot, started)
+        new_snapshot['generation'] = generation
+        with SNAPSHOT_LOCK:
+            SNAPSHOT = new_snapshot
+        if snapshot['time']:
+            emit_snapshot_events(snapshot, new_snapshot)
+        index_snapshot(snapshot, new_snapshot)
+        return new_snapshot
+
+
+def json_etag(data):
+    """ Strong ETag of json serializable data """
+    data = json.dumps(data, sort_keys=True)
+    return '"%s"' % hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+def etag_matches(etag, header):
+    """ True if an If-Match/If-None-Match header value lists etag
+
+    Weak comparison: W/ prefixes are ignored
+    """
+    tags = [tag.strip() for tag in header.split(',')]
+    return '*' in tags or etag.replace('W/', '') in [tag.replace('W/', '') for tag in tags]
+
+
+def not_modified(etag):
+    """ Set the ETag header, and 304 if If-None-Match lists it
+
+    @return: True if the body must not be sent
+    """
+    response.set_header('ETag', etag)
+    if_none_match = request.get_header('If-None-Match')
+    if if_none_match is not None and etag_matches(etag, if_none_match):
+        response.status = 304
+        return True
+    return False
+
+
+def number_param(value, cast, name):
+    """ cast(value) of a query parameter or header, 400 if it isn't a number """
+    try:
+        return cast(value)
+    except (TypeError, ValueError):
+        abort(400, '%s must be a number' % name)
+
+
+def get_snapshot(fresh=False):
+    """ Current state snapshot, taken now if fresh, stale or invalidated """
+    global SNAPSHOT_READ
+    SNAPSHOT_READ = time.time()
+    since = time.time() if fresh else time.time() - SNAPSHOT_TTL
+    with SNAPSHOT_LOCK:
+        snapshot = SNAPSHOT
+        valid = (snapshot['generation'] == SNAPSHOT_INVALIDATIONS
+                 and snapshot['time'] >= since)
+    if valid:
+        return snapshot
+    return refresh_snapshot(since)
+
+
+def invalidate_snapshot():
+    """ The states changed: next listing reads them again """
+    global SNAPSHOT_INVALIDATIONS
+    with SNAPSHOT_LOCK:
+        SNAPSHOT_INVALIDATIONS += 1
+    SNAPSHOT_WAKEUP.set()
+
+
+def snapshot_refresher():
+    """ Refresh the snapshot in background before it expires
+
+    Paused while no client reads the states or waits for events, and
+    no job waits for room
+    """
+    while True:
+        SNAPSHOT_WAKEUP.wait(SNAPSHOT_TTL / 2)
+        SNAPSHOT_WAKEUP.clear()
+        idle = time.time() - SNAPSHOT_READ > SNAPSHOT_IDLE_TTLS * SNAPSHOT_TTL
+        if idle and not EVENT_WAITERS and not ADMISSION_QUEUE and not ADMISSION_RESERVATIONS:
+            continue
+        try:
+            refresh_snapshot(time.time() - SNAPSHOT_TTL / 2)
+            drain_admission()
+        except Exception:
+            inc_metric('lxc_restapi_snapshot_refresh_failures_total', ())
+
+
+def emit_event(event_type, name, **data):
+    """ Append an event to the log and wake up the waiting clients """
+    global EVENT_ID
+    with EVENTS_CONDITION:
+        EVENT_ID += 1
+        event = {'id': EVENT_ID, 'type': event_type, 'container': name,
+                 'time': time.time()}
+        event.update(data)
+        EVENTS.append(event)
+        EVENTS_CONDITION.notify_all()
+
+
+def emit_snapshot_events(previous, snapshot):
+    """ created, destroyed, state and ips events between two snapshots """
+    before = dict((item['name'], item) for item in previous['containers'])
+    after = dict((item['name'], item) for item in snapshot['containers'])
+    for name in after:
+        if name not in before:
+            emit_event('created', name, state=after[name]['state'])
+        elif (after[name]['state'] is not None
+                and after[name]['state'] != before[name]['state']):
+            emit_event('state', name, state=after[name]['state'],
+                       previous=before[name]['state'])
+    for name in before:
+        if name not in after:
+            emit_event('destroyed', name)
+    for name, ips in snapshot['ips'].items():
+        if ips != previous['ips'].get(name):
+            emit_event('ips', name, ips=ips)
+
+
+def get_events(since, name=None, timeout=0):
+    """ Events after the id since, waits up to timeout for one to come
+
+    The events come from the snapshots: they are refreshed while
+    someone waits
+    """
+    global EVENT_WAITERS
+
+    def pending():
+        return [event for event in EVENTS if event['id'] > since
+                and (name is None or event['container'] == name)]
+    with EVENTS_CONDITION:
+        events = pending()
+        deadline = time.time() + timeout
+        EVENT_WAITERS += 1
+        try:
+            while not events and time.time() < deadline:
+                EVENTS_CONDITION.wait(deadline - time.time())
+                events = pending()
+        finally:
+            EVENT_WAITERS -= 1
+        return events, EVENT_ID
+
+
+def open_index(path):
+    """ Open the containers index, and serve the listing from it until
+    the background refresh reconciles it with lxc
+    """
+    global INDEX, SNAPSHOT
+    INDEX = sqlite3.connect(path, check_same_thread=False)
+    INDEX.execute("PRAGMA journal_mode=WAL")
+    #losing the last writes is fine, they are reconciled at start
+    INDEX.execute("PRAGMA synchronous=NORMAL")
+    INDEX.execute("""CREATE TABLE IF NOT EXISTS containers (
+                        name TEXT PRIMARY KEY,
+                        state TEXT,
+                        init_pid INTEGER,
+                        ips TEXT,
+                        template TEXT,
+                        created REAL,
+                        conf_hash TEXT,
+                        updated REAL)""")
+    INDEX.commit()
+    containers, ips = [], {}
+    rows = INDEX.execute("SELECT name, state, init_pid, ips, template, created "
+                         "FROM containers ORDER BY name")
+    for name, state, init_pid, row_ips, template, created in rows:
+        INDEX_META[name] = {"template": template, "created": created}
+        entry = {"name": name, "state": state, "init_pid": init_pid}
+        entry.update(INDEX_META[name])
+        containers.append(entry)
+        if row_ips and json.loads(row_ips):
+            ips[name] = json.loads(row_ips)
+    with SNAPSHOT_LOCK:
+        SNAPSHOT = {'containers': containers,
+                    'ips': ips,
+                    'time': time.time(),
+                    'generation': SNAPSHOT_INVALIDATIONS,
+                    'etag': 'W/' + json_etag(containers)}
+
+
+def write_index_row(name, fields):
+    """ Set columns of a container row, INDEX_LOCK held """
+    if 'ips' in fields:
+        fields['ips'] = json.dumps(fields['ips'])
+    for key in ('template', 'created'):
+        if key in fields:
+            INDEX_META.setdefault(name, {"template": None, "created": None})[key] = fields[key]
+    INDEX.execute("INSERT OR IGNORE INTO containers (name) VALUES (?)", (name, ))
+    INDEX.execute("UPDATE containers SET %s, updated = ? WHERE name = ?"
+                  % ", ".join("%s = ?" % key for key in fields),
+                  list(fields.values()) + [time.time(), name])
+
+
+def index_update(name, **fields):
+    """ Record changes to a container made by the server """
+    if INDEX is None:
+        return
+    with INDEX_LOCK:
+        write_index_row(name, fields)
+        INDEX.commit()
+
+
+def index_delete(name):
+    """ Forget a destroyed container """
+    if INDEX is None:
+        return
+    with INDEX_LOCK:
+        INDEX.execute("DELETE FROM containers WHERE name = ?", (name, ))
+        INDEX.commit()
+        INDEX_META.pop(name, None)
+        INDEX_PENDING.pop(name, None)
+
+
+def index_snapshot(previous, snapshot):
+    """ Write the containers whose state or ips changed between two snapshots,
+    and the conf hashes read since the last one
+    """
+    if INDEX is None:
+        return
+    before = dict((item['name'], item) for item in previous['containers'])
+    after = set()
+    with INDEX_LOCK:
+        for entry in snapshot['containers']:
+            name = entry['name']
+            after.add(name)
+            ips = snapshot['ips'].get(name, [])
+            old = before.get(name)
+            if (old is None or old['state'] != entry['state'] or old['init_pid'] != entry['init_pid']
+                    or previous['ips'].get(name, []) != ips):
+                write_index_row(name, {'state': entry['state'], 'init_pid': entry['init_pid'],
+                                       'ips': ips})
+        for name in set(before) - after:
+            INDEX.execute("DELETE FROM containers WHERE name = ?", (name, ))
+            INDEX_META.pop(name, None)
+        for name in list(INDEX_PENDING):
+            conf_hash = INDEX_PENDING.pop(name, None)
+            if name in after and conf_hash is not None:
+                write_index_row(name, {'conf_hash': conf_hash})
+        INDEX.commit()
+
+
+def start_snapshot_refresher():
+    thread = threading.Thread(target=snapshot_refresher, name="snapshot")
+    thread.daemon = True
+    thread.start()
 
 
 def set_container_conf(container, conf):
@@ -73,6 +1098,211 @@ def set_container_conf(container, conf):
     for key in conf:
         container.set_config_item(key, conf[key])
     container.save_config()
+    CONFIGS.pop(container.name, None)
+
+
+def config_mtime(container):
+    """ mtime of the config file of a container, None if there is none """
+    try:
+        path = container.config_file_name
+    except AttributeError:
+        path = os.path.join(container.get_config_path(), container.name, 'config')
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def cached_config(name, container):
+    """ Parsed configuration of a container, its lock held by the caller
+
+    Read again only when the config file changed since the last read
+    """
+    mtime = config_mtime(container)
+    cached = CONFIGS.get(name)
+    if cached is None or cached['mtime'] != mtime:
+        conf = OrderedDict()
+        for key in container.get_keys():
+            item = conf_item(container, key)
+            if item is not None:
+                conf[key] = item['value']
+        etag = json_etag(sorted(conf.items()))
+        version = 0
+        if cached is not None:
+            version = cached['version'] + (etag != cached['etag'])
+        if INDEX is not None and (cached is None or etag != cached['etag']):
+            #read routes call this: no sqlite write on their path
+            INDEX_PENDING[name] = etag
+        cached = {'conf': conf, 'mtime': mtime, 'etag': etag, 'version': version}
+        CONFIGS[name] = cached
+    return cached
+
+
+def conf_values(value):
+    """ Value of a conf key as a list of strings, for comparisons """
+    if value is None:
+        return []
+    if isinstance(value, list):
+        return [str(item) for item in value]
+    return [str(value)]
+
+
+def config_diff(current, wanted):
+    """ [{key, old, new}] of the keys of wanted whose value changes """
+    diff = []
+    for key, value in wanted.items():
+        if conf_values(current.get(key)) != conf_values(value):
+            diff.append({'key': key, 'old': current.get(key), 'new': value})
+    return diff
+
+
+def apply_config_diff(name, container, diff):
+    """ Set the changed keys, save the config file only if there are some
+
+    multi-valued keys are cleared first so that removed values go away
+    """
+    if not diff:
+        return False
+    for change in diff:
+        if (isinstance(change['old'], list) or isinstance(change['new'], list)
+                or change['key'].startswith(CGROUP_CONF_PREFIX)):
+            container.clear_config_item(change['key'])
+            for value in conf_values(change['new']):
+                container.set_config_item(change['key'], value)
+        else:
+            container.set_config_item(change['key'], change['new'])
+    if not container.save_config():
+        abort(500, 'container.save_config() failed')
+    cached = CONFIGS.get(name)
+    for change in diff:
+        item = conf_item(container, change['key'])
+        if item is None:
+            cached['conf'].pop(change['key'], None)
+        else:
+            cached['conf'][change['key']] = item['value']
+    cached['mtime'] = config_mtime(container)
+    cached['etag'] = json_etag(sorted(cached['conf'].items()))
+    cached['version'] += 1
+    INDEX_PENDING.pop(name, None)
+    index_update(name, conf_hash=cached['etag'])
+    return True
+
+
+def read_leases(path):
+    """ {mac: [ip]} of a dnsmasq lease file: expiry mac ip hostname clientid """
+    retval = {}
+    with open(path) as leases:
+        for line in leases:
+            fields = line.split()
+            if len(fields) >= 3:
+                retval.setdefault(fields[1].lower(), []).append(fields[2])
+    return retval
+
+
+def read_arp(path):
+    """ {mac: [ip]} of the complete entries of the neighbour table """
+    retval = {}
+    with open(path) as table:
+        next(table, None)
+        for line in table:
+            fields = line.split()
+            #IP address, HW type, Flags, HW address, Mask, Device
+            if len(fields) >= 4 and fields[2] != '0x0' and fields[3] != '00:00:00:00:00:00':
+                retval.setdefault(fields[3].lower(), []).append(fields[0])
+    return retval
+
+
+def refresh_ip_index():
+    """ Read the lease files which changed since the last refresh
+
+    The neighbour table has no mtime, it is read each time
+    """
+    global IP_INDEX
+    sources = [(path, read_leases) for path in DHCP_LEASES]
+    if ARP_TABLE:
+        sources.append((ARP_TABLE, read_arp))
+    changed = False
+    for path, reader in sources:
+        try:
+            mtime = os.stat(path).st_mtime
+            if path != ARP_TABLE and IP_SOURCES.get(path, (None, ))[0] == mtime:
+                continue
+            ips = reader(path)
+        except (IOError, OSError):
+            mtime, ips = None, {}
+        if IP_SOURCES.get(path, (None, {}))[1] != ips:
+            changed = True
+        IP_SOURCES[path] = (mtime, ips)
+    if changed:
+        index = {}
+        for path, reader in sources:
+            for mac, ips in IP_SOURCES[path][1].items():
+                index.setdefault(mac, [])
+                index[mac].extend(ip for ip in ips if ip not in index[mac])
+        with IP_INDEX_LOCK:
+            IP_INDEX = index
+
+
+def container_hwaddrs(name, container):
+    """ mac addresses of the network config of a container, its lock held by the caller """
+    cached = cached_config(name, container)
+    if HWADDRS.get(name, (None, ))[0] != cached['etag']:
+        macs = [str(value).lower() for key, value in cached['conf'].items()
+                if re.match(r'lxc\.network\.(\d+\.)?hwaddr$', key)]
+        if not macs:
+            #lxc lists the network keys under lxc.network only
+            try:
+                macs = [str(network.hwaddr).lower() for network in container.network
+                        if network.hwaddr]
+            except (AttributeError, TypeError):
+                macs = []
+        HWADDRS[name] = (cached['etag'], macs)
+    return HWADDRS[name][1]
+
+
+def lookup_ips(name, container, state, timeout=IPS_PROBE_TIMEOUT, probe=True):
+    """ ips of a container, its lock held by the caller
+
+    Read in the ips index by mac address; get_ips() enters the container
+    network namespace only when it misses, and if probe
+    """
+    if state not in ("RUNNING", "FROZEN"):
+        return []
+    with IP_INDEX_LOCK:
+        index = IP_INDEX
+    ips = []
+    for mac in (container_hwaddrs(name, container) if index else []):
+        ips.extend(ip for ip in index.get(mac, []) if ip not in ips)
+    if ips:
+        inc_metric('lxc_restapi_ip_lookups_total', (('source', 'index'), ))
+        return ips
+    if not probe:
+        return []
+    return probe_ips(name, container, None, timeout)
+
+
+def probe_ips(name, container, init_pid, timeout=IPS_PROBE_TIMEOUT):
+    """ get_ips() of a running container
+
+    With its init_pid, the ips found are reused until it restarts or
+    for IPS_PROBE_BACKOFF; a container found without ips is not probed
+    again before a delay doubling up to IPS_PROBE_BACKOFF
+    """
+    probed = PROBED_IPS.get(name) if init_pid is not None else None
+    if probed is not None and probed[0] != init_pid:
+        probed = None
+    if probed is not None and time.time() < probed[2]:
+        inc_metric('lxc_restapi_ip_lookups_total', (('source', 'cache'), ))
+        return probed[1]
+    inc_metric('lxc_restapi_ip_lookups_total', (('source', 'probe'), ))
+    ips = container.get_ips(timeout=timeout)
+    if init_pid is not None:
+        if ips:
+            delay = IPS_PROBE_BACKOFF
+        else:
+            delay = min(IPS_PROBE_BACKOFF, probed[3] * 2) if probed is not None and not probed[1] else 1
+        PROBED_IPS[name] = (init_pid, ips, time.time() + delay, delay)
+    return ips
 
 
 """ 
@@ -157,7 +1387,6 @@ DOC_MODEL_CONTAINER = {
             }
 }
 
-#@TODO: propose a list of available templates
 DOC_MODEL_TEMPLATE = {
             "id":"template",
             "properties":{
@@ -183,32 +1412,217 @@ DOC_API_CONTAINERS_COLLECTION['operations'].append({
             "httpMethod":"GET",
             "nickname":"getContainers",
             "responseClass":"void",
-            "parameters":[],
-            "summary":"Get the list of containers collection",
-            "notes": "",
-            "errorResponses":[]
-                      })
-
-@route(PREFIX + '/containers', method='GET')
-def get_container_list():
-    retval = {}
-    retval['containers'] = []
-    for name in lxc.list_containers():
-        c = get_container_object(name)
-        retval['containers'].append({
-               "name": name,
-               "state": c.state,
-               "init_pid": c.init_pid})
-    return retval
-
-
-
-"""POST on container collection"""
-DOC_API_CONTAINERS_COLLECTION['operations'].append({
+            "parameters":[{
+                "name":"fresh",
+                "allowMultiple": False,
+                "dataType": "boolean",
+                "description": "1 to read the states now instead of using the snapshot, only of the containers matching name_prefix if given",
+                "paramType": "query",
+                "required": False
+                },{
+                "name":"state",
+                "allowMultiple": False,
+                "dataType": "string",
+                "description": "comma separated states to keep, e.g. RUNNING,FROZEN",
+                "paramType": "query",
+                "required": False
+                },{
+                "name":"name_prefix",
+                "allowMultiple": False,
+                "dataType": "string",
+                "description": "keep the containers whose name starts with it",
+                "paramType": "query",
+                "required": False
+                },{
+                "name":"sort",
+                "allowMultiple": False,
+                "dataType": "string",
+                "description": "comma separated keys among %s, -key for descending (default: name)" % ",".join(LISTING_SORT_KEYS),
+                "paramType": "query",
+                "required": False
+                },{
+                "name":"limit",
+                "allowMultiple": False,
+                "dataType": "int",
+                "description": "max containers returned, next_cursor then gives the next page",
+                "paramType": "query",
+                "required": False
+                },{
+                "name":"cursor",
+                "allowMultiple": False,
+                "dataType": "string",
+                "description": "next_cursor of the previous page, with the same sort",
+                "paramType": "query",
+                "required": False
+                },{
+                "name":"detail",
+                "allowMultiple": False,
+                "dataType": "string",
+                "description": "comma separated parts to embed in each container: %s" % ",".join(LISTING_DETAILS),
+                "paramType": "query",
+                "required": False
+                }],
+            "summary":"Get the list of containers collection",
+            "notes": "served from a snapshot of the states, snapshot_age is its age in seconds; filters, sort and pages apply to the snapshot, not to lxc. The weak ETag changes with the containers states, If-None-Match answers 304 while they don't. detail parts are only computed when asked, for the returned page: ips come from the snapshot, conf_hash is the ETag of the conf, read in parallel",
+            "errorResponses":[{"code": 400, "reason": "Unknown state, sort key or detail, bad limit or cursor"}]
+                      })
+
+
+class Descending(object):
+    """ Sort key wrapper reversing the order of a value """
+    __slots__ = ('value', )
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+def listing_sort_key(keys):
+    """ Sort key of listing entries: keys, '-key' descending, then name """
+    def sort_key(entry):
+        values = []
+        for key in keys:
+            value = entry.get(key.lstrip('-'))
+            #None last, never compared with a value
+            value = (value is None, value if value is not None else 0)
+            values.append(Descending(value) if key.startswith('-') else value)
+        values.append(entry['name'])
+        return tuple(values)
+    return sort_key
+
+
+def encode_cursor(entry, keys):
+    """ Opaque cursor after entry: its sort values and name """
+    values = [entry.get(key.lstrip('-')) for key in keys] + [entry['name']]
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor, keys):
+    """ Entry like dict of a cursor, 400 if it doesn't match keys """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+    except ValueError:
+        abort(400, 'Bad cursor')
+    if not isinstance(values, list) or len(values) != len(keys) + 1:
+        abort(400, 'Cursor of another sort')
+    entry = dict(zip([key.lstrip('-') for key in keys], values))
+    entry['name'] = values[-1]
+    #compared with the entries: a value of another type would raise
+    for key, value in entry.items():
+        if not isinstance(value, LISTING_SORT_TYPES[key]) and (value is not None or key == 'name'):
+            abort(400, 'Bad cursor')
+    return entry
+
+
+def listing_conf_hash(name):
+    """ ETag of the conf of a container, the cached one if it is busy """
+    lock = container_lock(name)
+    if not lock.acquire(timeout=SNAPSHOT_LOCK_TIMEOUT):
+        return CONFIGS.get(name, {}).get('etag')
+    try:
+        return cached_config(name, get_container_object(name))['etag']
+    finally:
+        lock.release()
+
+
+def listing_details(containers, details, snapshot):
+    """ Copies of the listing entries with the detail parts added """
+    containers = [dict(entry) for entry in containers]
+    if 'conf_hash' in details:
+        hashes = get_snapshot_executor().map(listing_conf_hash,
+                                             [entry['name'] for entry in containers])
+        for entry, conf_hash in zip(containers, hashes):
+            entry['conf_hash'] = conf_hash
+    for entry in containers:
+        if 'ips' in details:
+            entry['ips'] = snapshot['ips'].get(entry['name'], [])
+        if 'actions' in details:
+            entry['actions'] = ACTIONS_BY_STATE.get(entry['state'], [])
+    return containers
+
+
+@route(PREFIX + '/containers', method='GET')
+def get_container_list():
+    query = request.query
+    states = None
+    if query.get('state'):
+        states = set(query.get('state').split(','))
+        if states - set(ACTIONS_BY_STATE):
+            abort(400, 'Unknown states: %s' % ', '.join(sorted(states - set(ACTIONS_BY_STATE))))
+    prefix = query.get('name_prefix', '')
+    sort = [key for key in query.get('sort', '').split(',') if key]
+    if set(key.lstrip('-') for key in sort) - set(LISTING_SORT_KEYS):
+        abort(400, 'Unknown sort keys, use %s' % ', '.join(LISTING_SORT_KEYS))
+    limit = None
+    if query.get('limit'):
+        try:
+            limit = int(query.get('limit'))
+        except ValueError:
+            limit = 0
+        if limit < 1:
+            abort(400, 'limit must be a positive integer')
+    details = [part for part in query.get('detail', '').split(',') if part]
+    if set(details) - set(LISTING_DETAILS):
+        abort(400, 'Unknown detail, use %s' % ', '.join(LISTING_DETAILS))
+
+    if query.get('fresh') == '1' and prefix:
+        #only the matching containers are read
+        with SNAPSHOT_LOCK:
+            snapshot = SNAPSHOT
+        snapshot = read_states([name for name in list_containers() if name.startswith(prefix)],
+                               snapshot, time.time())
+    else:
+        snapshot = get_snapshot(fresh=query.get('fresh') == '1')
+    etag = snapshot['etag']
+    if states is not None or prefix or sort or limit or query.get('cursor') or details:
+        etag = 'W/' + json_etag([etag, request.query_string])
+    if not details and not_modified(etag):
+        return ''
+
+    containers = snapshot['containers']
+    if prefix:
+        containers = [entry for entry in containers if entry['name'].startswith(prefix)]
+    if states is not None:
+        containers = [entry for entry in containers if entry['state'] in states]
+    if sort or limit or query.get('cursor'):
+        sort_key = listing_sort_key(sort)
+        containers = sorted(containers, key=sort_key)
+        total = len(containers)
+        if query.get('cursor'):
+            after = sort_key(decode_cursor(query.get('cursor'), sort))
+            containers = [entry for entry in containers if after < sort_key(entry)]
+    retval = {}
+    if limit:
+        retval['total'] = total
+        retval['next_cursor'] = None
+        if len(containers) > limit:
+            containers = containers[:limit]
+            retval['next_cursor'] = encode_cursor(containers[-1], sort)
+    if details:
+        #the parts aren't in the snapshot ETag
+        containers = listing_details(containers, details, snapshot)
+        etag = 'W/' + json_etag([etag] + [[entry.get(part) for part in details]
+                                         for entry in containers])
+        if not_modified(etag):
+            return ''
+    retval['containers'] = containers
+    retval['snapshot_age'] = time.time() - snapshot['time']
+    return retval
+
+
+
+"""POST on container collection"""
+DOC_API_CONTAINERS_COLLECTION['operations'].append({
             "httpMethod":"POST",
             "nickname":"newContainer",
             "responseClass":"void",
             "summary":"Create a container",
+            "notes": "creation is queued: 202 and a job, see /jobs/{id}",
             "parameters":[{
                 "allowMultiple": False,
                 "dataType": "container",
@@ -220,17 +1634,22 @@ DOC_API_CONTAINERS_COLLECTION['operations'].append({
 
 @route(PREFIX + '/containers', method='POST')
 def add_container():
+    """ Queue the creation, returns 202 and the job """
     data = request.json
     if len(data) == 0:
         abort(400, 'No data received')
     
     name = data['name']
-    container = get_container_object(name)
     
     #conf management
     conf= {}
     if 'conf' in data:
         conf = keyval_list_to_dict(data['conf'])
+
+    #cgroups, applied at each start
+    if data.get('cgroups'):
+        for key, value in keyval_list_to_dict(data['cgroups']).items():
+            conf[CGROUP_CONF_PREFIX + key] = value
   
     #template management
     template_name = DEFAULT_TEMPLATE
@@ -239,13 +1658,31 @@ def add_container():
         template_args = keyval_list_to_dict(data['template']['args'])
         template_name = data['template']['name']
     
+    return job_accepted(submit_admitted_job('create', name, {'disk': ADMISSION_CREATE_DISK},
+                                            create_container,
+                                            name, template_name, template_args, conf))
+
+
+def create_container(name, template_name, template_args, conf):
+    """ Job: run the template, apply conf, returns container details
+
+    With the golden pool, clones the base container of the template
+    """
+    if GOLDEN_POOL:
+        base = create_golden(template_name, template_args)
+        details = clone_container(base, name, True, GOLDEN_BDEVTYPE, conf)
+        index_update(name, template=template_name)
+        return details
+    container = get_container_object(name)
     print("will create container with %s, %s" %( template_name, template_args))       
-    if container.create(template_name, template_args):
-        if len(conf) > 0:
-            set_container_conf(container, conf)
-        return get_container(data['name'])
-    else:
-        abort(500, 'container.create failed')
+    with container_lock(name):
+        if container.create(template_name, template_args):
+            index_update(name, template=template_name, created=time.time())
+            if len(conf) > 0:
+                set_container_conf(container, conf)
+            return container_details(name)
+        else:
+            abort(500, 'container.create failed')
 
 DOC_API["apis"].append(DOC_API_CONTAINERS_COLLECTION)
 
@@ -272,45 +1709,95 @@ DOC_API_CONTAINERS_ITEM['operations'].append({
                 "description": "container name",
                 "paramType": "path",
                 "required": True
+                },{
+                "name":"fields",
+                "allowMultiple": False,
+                "dataType": "string",
+                "description": "comma separated fields to compute: %s (default: all)" % ",".join(CONTAINER_FIELDS),
+                "paramType": "query",
+                "required": False
+                },{
+                "name":"conf_keys",
+                "allowMultiple": False,
+                "dataType": "string",
+                "description": "comma separated conf keys to read (default: all keys of get_keys())",
+                "paramType": "query",
+                "required": False
                 }],
             "summary":"Get details about a container",
-            "notes": "",
+            "notes": "only the requested fields are read from lxc, e.g. fields=state,ips for polling loops. The ETag is made of the state, init_pid, ips and conf ETag, If-None-Match answers 304 while they don't change",
             "errorResponses":[]
                       })
 
 @route(PREFIX + '/containers/:name', method='GET')
 #get container details by name
 def get_container(name):
+    fields = CONTAINER_FIELDS
+    conf_keys = None
+    if request.query.get('fields'):
+        fields = [field for field in request.query.get('fields').split(',') if field] or CONTAINER_FIELDS
+        unknown = set(fields) - set(CONTAINER_FIELDS)
+        if unknown:
+            abort(400, 'Unknown fields: %s' % ', '.join(sorted(unknown)))
+    if request.query.get('conf_keys'):
+        conf_keys = [key for key in request.query.get('conf_keys').split(',') if key] or None
+    with container_lock(name):
+        details = container_details(name, fields, conf_keys)
+        if not_modified(details_etag(name, details, conf_keys)):
+            return ''
+        return details
+
+
+def details_etag(name, details, conf_keys=None):
+    """ ETag of container details, its lock held by the caller
+
+    The whole conf is represented by its ETag, not serialized again
+    """
+    parts = dict((key, value) for key, value in details.items() if key != 'conf')
+    if 'conf' in details:
+        parts['conf'] = details['conf'] if conf_keys is not None else CONFIGS[name]['etag']
+    return json_etag(parts)
+
+
+def conf_item(container, key):
+    """ {key, value, typeOf} of a conf item, None if it can't be read """
+    try:
+        value = container.get_config_item(key)
+    except KeyError:
+        print("%s, get_keys give it but doesn\'t exists :-/" % key)
+        return None
+    except UnicodeDecodeError:
+        print("%s, get_keys give it but doesn\'t exists :-/" % key)
+        return None
+    return {"key": key, "value": value, "typeOf": type(value).__name__}
+
+
+def container_details(name, fields=CONTAINER_FIELDS, conf_keys=None):
+    """ Details of a container, its lock held by the caller
+
+    Only the requested fields are read; conf_keys limits conf to these keys
+    """
     retval = {}
     container = get_container_object(name)
-    retval['name'] = container.name
-    retval['state'] = container.state
-    retval['init_pid'] = container.init_pid
-    retval['conf'] = []
-    for key in container.get_keys():
-        try:
-            #print(repr(container.get_config_item(key)))
-            value = container.get_config_item(key)
-            if type(value) == list:
-                datatype = "list"
-            if type(value) == int:
-                datatype = "int"
-            if type(value) == str:
-                datatype = "str"
-            if type(value) == bool:
-                datatype = "bool"
-            retval['conf'].append({"key": key,
-                                   "value": container.get_config_item(key),
-                                   "typeOf": datatype})
-            del datatype
-            del value
-        except KeyError:
-            print("%s, get_keys give it but doesn\'t exists :-/" % key)
-        except UnicodeDecodeError:
-            print("%s, get_keys give it but doesn\'t exists :-/" % key)
-    retval['ips'] = container.get_ips()
-    
-    retval['actions'] = ACTIONS_BY_STATE[retval['state']]
+    if 'name' in fields:
+        retval['name'] = container.name
+    if 'state' in fields or 'actions' in fields or 'ips' in fields:
+        state = container.state
+        if 'state' in fields:
+            retval['state'] = state
+    if 'init_pid' in fields:
+        retval['init_pid'] = container.init_pid
+    if conf_keys is not None:
+        retval['conf'] = [item for item in
+                          (conf_item(container, key) for key in conf_keys)
+                          if item is not None]
+    elif 'conf' in fields:
+        retval['conf'] = [{"key": key, "value": value, "typeOf": type(value).__name__}
+                          for key, value in cached_config(name, container)['conf'].items()]
+    if 'ips' in fields:
+        retval['ips'] = lookup_ips(name, container, state, timeout=0)
+    if 'actions' in fields:
+        retval['actions'] = ACTIONS_BY_STATE[state]
     return retval
 
 """DELETE on container """
@@ -334,7 +1821,14 @@ DOC_API_CONTAINERS_ITEM['operations'].append({
 @route(PREFIX + '/containers/:name', method='DELETE')
 #destroy a container
 def delete_container(name):
-    get_container_object(name).destroy()
+    with action_limit('destroy').slot():
+        with container_lock(name):
+            get_container_object(name).destroy()
+            CONFIGS.pop(name, None)
+            PROBED_IPS.pop(name, None)
+            index_delete(name)
+    close_sessions(name)
+    invalidate_snapshot()
 
 """PUT on container """
 DOC_API_CONTAINERS_ITEM['operations'].append({
@@ -349,43 +1843,85 @@ DOC_API_CONTAINERS_ITEM['operations'].append({
                 "required": True
                 }],
             "summary":"modify a container",
-            "notes": "",
-            "errorResponses":[]
+            "notes": "only the conf keys whose value changes are written, the config file is saved only if there are some; returns the applied diff and the conf ETag. With If-Match, answers 412 if the conf changed since that ETag",
+            "errorResponses":[{"code": 412, "reason": "conf changed since If-Match ETag"}]
                       })
 @route(PREFIX + '/containers/:name', method='PUT')
 def modify_container(name):
     data = request.json
-    if len(data) == 0:
+    if not data:
         abort(400, 'No data received')
 
-    if 'conf' in data:
-        set_container_conf(get_container_object(name), data['conf'])
+    container = get_container_object(name)
+    with container_lock(name):
+        cached = cached_config(name, container)
+        if_match = request.get_header('If-Match')
+        if if_match is not None and not etag_matches(cached['etag'], if_match):
+            abort(412, 'conf of %s changed, its ETag is %s' % (name, cached['etag']))
+        diff = []
+        if 'conf' in data:
+            diff = config_diff(cached['conf'], keyval_list_to_dict(data['conf']))
+        saved = apply_config_diff(name, container, diff)
+        response.set_header('ETag', cached['etag'])
+        return {'diff': diff, 'saved': saved, 'etag': cached['etag']}
 
 DOC_API["apis"].append(DOC_API_CONTAINERS_ITEM)
 
 
-@route(PREFIX + '/containers/:name/ips', method='GET')
-#get container ips addresses
-def get_container_ip(name):
-    retval = {}
-    retval['ips'] = get_container_object(name).get_ips(timeout=10)
-    return retval
+DOC_API_CONTAINER_CONF = {
+            "description": "Container conf",
+            "operations": [],
+            "path": "/containers/{name}/conf",
+            "summary":"Container configuration",
+            "notes": "",
+            "errorResponses":[]}
+
+DOC_API_CONTAINER_CONF['operations'].append({
+            "httpMethod":"GET",
+            "nickname":"getContainerConf",
+            "responseClass":"void",
+            "parameters":[{
+                "name":"name",
+                "allowMultiple": False,
+                "dataType": "string",
+                "description": "container name",
+                "paramType": "path",
+                "required": True
+                }],
+            "summary":"Get the conf of a container and its ETag, to use as If-Match of a PUT",
+            "notes": "served from the parsed conf, read again only when the config file changes",
+            "errorResponses":[]
+                      })
+
+@route(PREFIX + '/containers/:name/conf', method='GET')
+def get_container_conf(name):
+    container = get_container_object(name)
+    with container_lock(name):
+        cached = cached_config(name, container)
+        if not_modified(cached['etag']):
+            return ''
+        return {'conf': [{"key": key, "value": value, "typeOf": type(value).__name__}
+                         for key, value in cached['conf'].items()],
+                'etag': cached['etag'],
+                'version': cached['version']}
+
+DOC_API["apis"].append(DOC_API_CONTAINER_CONF)
+
 
 """ 
-    Container's actions
+    Container's cgroups
 """
-DOC_API_CONTAINER_ACTIONS = {
-            "description": "Container actions",
+DOC_API_CONTAINER_CGROUPS = {
+            "description": "Container cgroups",
             "operations": [],
-            "path": "/containers/{name}/actions/{action}",
-            "summary":"Container item manipulation",
+            "path": "/containers/{name}/cgroups",
+            "summary":"Container cgroup items",
             "notes": "",
             "errorResponses":[]}
 
-"""PUT on container """
-DOC_API_CONTAINER_ACTIONS['operations'].append({
-            "httpMethod":"POST",
-            "nickname":"putContainer",
+DOC_API_CONTAINER_CGROUPS['operations'].append({
+            "httpMethod":"GET",
+            "nickname":"getContainerCgroups",
             "responseClass":"void",
             "parameters":[{
                 "name":"name",
@@ -395,211 +1931,2228 @@ DOC_API_CONTAINER_ACTIONS['operations'].append({
                 "paramType": "path",
                 "required": True
                 },{
-                "name":"action",
+                "name":"keys",
                 "allowMultiple": False,
                 "dataType": "string",
-                "description": "container action to perform",
+                "description": "comma separated cgroup items to read besides the configured ones, e.g. memory.usage_in_bytes",
+                "paramType": "query",
+                "required": False
+                }],
+            "summary":"Get the cgroup items of a container",
+            "notes": "configured is the lxc.cgroup.* conf value applied at start, value the live one (null when stopped)",
+            "errorResponses":[]
+                      })
+
+DOC_API_CONTAINER_CGROUPS['operations'].append({
+            "httpMethod":"PUT",
+            "nickname":"putContainerCgroups",
+            "responseClass":"void",
+            "parameters":[{
+                "name":"name",
+                "allowMultiple": False,
+                "dataType": "string",
+                "description": "container name",
                 "paramType": "path",
-                "required": True,
-                "allowableValues":{
-                        "valueType":"LIST",
-                        "values":[
-                                  "start",
-                                  "shutdown",
-                                  "restart",
-                                  "freeze",
-                                  "unfreeze",
-                                  "chrootcmd",
-                                  "destroy",
-                                  "attach"
-                                  ]
-                                   }
+                "required": True
                 },{
-                "name":"cmd",
                 "allowMultiple": False,
                 "dataType": "string",
-                "description": "for chrootcmd and attach, the command to execute",
+                "description": "{cgroups: [{key: memory.limit_in_bytes, val: 536870912}, ...], persist: true}",
                 "paramType": "body",
-                "required": False
-                }
-                ],
-            "summary":"perform {action} on a container",
-            "notes": "",
-            "errorResponses":[]
+                "required": True
+                }],
+            "summary":"Set cgroup items of a container",
+            "notes": "set live if the container runs, and written in its conf unless persist is false",
+            "errorResponses":[{"code": 400, "reason": "cgroup item refused"}]
                       })
 
 
-@route(PREFIX + '/containers/:name/actions/start', method='POST')
-#start it
-def start_container(name):
-    container = get_container_object(name)
-    if not container.start():
-        abort(500, 'container.start() failed')
-    container.wait("RUNNING", 3)
+def configured_cgroups(conf):
+    """ cgroup items of a parsed conf, without the lxc.cgroup. prefix
 
+    liblxc gives them either as keys of their own or all as the lines of
+    the lxc.cgroup key
+    """
+    cgroups = OrderedDict()
+    for line in conf_values(conf.get(CGROUP_CONF_PREFIX[:-1])):
+        key, sep, value = line.partition('=')
+        if sep and key.strip().startswith(CGROUP_CONF_PREFIX):
+            cgroups[key.strip()[len(CGROUP_CONF_PREFIX):]] = value.strip()
+    for key, value in conf.items():
+        if key.startswith(CGROUP_CONF_PREFIX):
+            cgroups[key[len(CGROUP_CONF_PREFIX):]] = value
+    return cgroups
 
-@route(PREFIX + '/containers/:name/actions/shutdown', method='POST')
-#shut it down
-def shutdown_container(name):
+
+def cgroup_items(name, container, keys=()):
+    """ [{key, value, configured}] of a container, its lock held by the caller """
+    configured = configured_cgroups(cached_config(name, container)['conf'])
+    running = container.running
+    items = []
+    for key in list(configured) + [key for key in keys if key not in configured]:
+        value = None
+        if running:
+            try:
+                value = container.get_cgroup_item(key)
+            except KeyError:
+                pass
+        items.append({'key': key, 'value': value, 'configured': configured.get(key)})
+    return items
+
+
+@route(PREFIX + '/containers/:name/cgroups', method='GET')
+def get_container_cgroups(name):
+    keys = [key for key in request.query.get('keys', '').split(',') if key]
     container = get_container_object(name)
-    if not container.shutdown(timeout=10):
-        abort(500, 'container.shutdown() failed')
+    with container_lock(name):
+        return {'cgroups': cgroup_items(name, container, keys)}
 
 
-@route(PREFIX + '/containers/:name/actions/stop', method='POST')
-#shut it down
-def stop_container(name):
+@route(PREFIX + '/containers/:name/cgroups', method='PUT')
+def modify_container_cgroups(name):
+    data = request.json
+    if not data or not data.get('cgroups'):
+        abort(400, 'No cgroups received')
+    cgroups = keyval_list_to_dict(data['cgroups'])
+
     container = get_container_object(name)
-    if not container.stop():
-        abort(500, 'container.shutdown() failed')
-    container.wait("STOPPED", 10)
+    with container_lock(name):
+        if container.running:
+            for key, value in cgroups.items():
+                for item in conf_values(value):
+                    if not container.set_cgroup_item(key, item):
+                        abort(400, 'container.set_cgroup_item(%s) failed' % key)
+        if data.get('persist', True):
+            wanted = dict((CGROUP_CONF_PREFIX + key, value) for key, value in cgroups.items())
+            apply_config_diff(name, container,
+                              config_diff(cached_config(name, container)['conf'], wanted))
+        return {'cgroups': cgroup_items(name, container, list(cgroups))}
 
+DOC_API["apis"].append(DOC_API_CONTAINER_CGROUPS)
 
-@route(PREFIX + '/containers/:name/actions/restart', method='POST')
-#restart it
-def restart_container(name):
-    shutdown_container(name)
-    stop_container(name)
-    start_container(name)
 
+""" 
+    Container's stats
+"""
+DOC_API_CONTAINER_STATS = {
+            "description": "Container stats",
+            "operations": [],
+            "path": "/containers/{name}/stats",
+            "summary":"Container resources usage",
+            "notes": "",
+            "errorResponses":[]}
 
-@route(PREFIX + '/containers/:name/actions/freeze', method='POST')
-#freeze it
-def freeze_container(name):
-    container = get_container_object(name)
-    if not container.freeze():
-        abort(500, 'container.freeze() failed')
-    container.wait("FROZEN", 10)
+DOC_API_CONTAINER_STATS['operations'].append({
+            "httpMethod":"GET",
+            "nickname":"getContainerStats",
+            "responseClass":"void",
+            "parameters":[{
+                "name":"name",
+                "allowMultiple": False,
+                "dataType": "string",
+                "description": "container name",
+                "paramType": "path",
+                "required": True
+                }],
+            "summary":"Get the cpu, memory and block I/O usage of a container",
+            "notes": "read from the cgroup filesystem, not through lxc; usages are null when the container is stopped or the kernel doesn't account them",
+            "errorResponses":[]
+                      })
 
 
-@route(PREFIX + '/containers/:name/actions/unfreeze', method='POST')
-#unfreeze it
-def unfreeze_container(name):
-    container = get_container_object(name)
-    if not container.unfreeze():
-        abort(500, 'container.unfreeze() failed')
-    container.wait("RUNNING", 10)
+def cgroup_mounts():
+    """ controller -> mount point of the cgroup hierarchies """
+    global CGROUP_MOUNTS
+    if CGROUP_MOUNTS is None:
+        mounts = {}
+        with open('/proc/self/mounts') as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) < 4:
+                    continue
+                if parts[2] == 'cgroup2':
+                    mounts.setdefault('', parts[1])
+                elif parts[2] == 'cgroup':
+                    for option in parts[3].split(','):
+                        mounts.setdefault(option, parts[1])
+        CGROUP_MOUNTS = mounts
+    return CGROUP_MOUNTS
 
 
-@route(PREFIX + '/containers/:name/actions/destroy', method='POST')
-#unfreeze it
-def destroy_container(name):
-    container = get_container_object(name)
-    if not container.destroy():
-        abort(500, 'container.destroy() failed')
+def cgroup_dirs(pid):
+    """ controller -> cgroup directory of a process ("" for cgroup2) """
+    mounts = cgroup_mounts()
+    dirs = {}
+    with open('/proc/%d/cgroup' % pid) as f:
+        for line in f:
+            hierarchy, controllers, path = line.rstrip('\n').split(':', 2)
+            for controller in controllers.split(',') if controllers else ['']:
+                if controller in mounts:
+                    dirs[controller] = mounts[controller] + path
+    return dirs
 
-    
-@route(PREFIX + '/containers/:name/actions/chrootcmd', method='POST')
-def chrootcmd(name):
-    """
-    Exec a command in container "name" with chroot
-    example:
-        input : {'cmd':'ls /'}
-        returns : {'output':'bin  boot  dev  etc  home ... usr  var'}
-    """
-    data = request.json
-    if len(data) == 0:
-        abort(400, 'No data received')
 
-    container = get_container_object(name)
-    rootfs = container.get_config_item('lxc.rootfs')
+def read_cgroup_file(dirs, controller, filename):
+    """ Content of a cgroup file, None if it can't be read """
+    if controller not in dirs:
+        return None
+    try:
+        with open(os.path.join(dirs[controller], filename)) as f:
+            return f.read()
+    except (IOError, OSError):
+        return None
 
-    cmd = ['chroot', rootfs]
-    cmd.extend(shlex.split(data['cmd']))
 
-    output = subprocess.check_output(cmd, shell=True)
-    retval = {}
-    retval['output'] = output
-    return retval
+def cgroup_int(text):
+    """ int of a single value cgroup file, None for "max" or no file """
+    try:
+        return int(text)
+    except (TypeError, ValueError):
+        return None
 
-    ##fork and chroot
-    #r, w = os.pipe()
-    #pid = os.fork()
-    #if pid:
-        #os.close(w)
-        #r = os.fdopen(r)
-        #print("chrootexec child forked")
-        #txt = r.read()
-        #os.waitpid(pid, 0)
-    #else:
-        #os.close(r)
-        #w = os.fdopen(w, 'w')
-        #print("chrooting into %s" % rootfs)
-        #os.chroot("%s" % rootfs)
-        #print("executing %s" % data['cmd'])
-        #output = subprocess.check_output(data['cmd'], shell=True)
-        #w.write("%s" % output)
-        #w.close()
-        #print("child: closing")
-        #os._exit(0)
-    #retval = {}
-    #retval['output'] = txt
-    #return retval
+
+def cgroup_stats(pid):
+    """ {cpu, memory, blkio} usage of the cgroups of a process
+
+    cgroup v1 controllers are used when mounted, cgroup2 files otherwise
+    """
+    stats = {'cpu': {'usage_ns': None},
+             'memory': {'usage_bytes': None, 'limit_bytes': None},
+             'blkio': {'read_bytes': None, 'write_bytes': None}}
+    if pid is None or pid <= 0:
+        return stats
+    try:
+        dirs = cgroup_dirs(pid)
+    except (IOError, OSError):
+        return stats
+
+    if 'cpuacct' in dirs:
+        stats['cpu']['usage_ns'] = cgroup_int(read_cgroup_file(dirs, 'cpuacct', 'cpuacct.usage'))
+    else:
+        for line in (read_cgroup_file(dirs, '', 'cpu.stat') or '').splitlines():
+            if line.startswith('usage_usec '):
+                stats['cpu']['usage_ns'] = int(line.split()[1]) * 1000
+
+    if 'memory' in dirs:
+        stats['memory']['usage_bytes'] = cgroup_int(read_cgroup_file(dirs, 'memory', 'memory.usage_in_bytes'))
+        stats['memory']['limit_bytes'] = cgroup_int(read_cgroup_file(dirs, 'memory', 'memory.limit_in_bytes'))
+    else:
+        stats['memory']['usage_bytes'] = cgroup_int(read_cgroup_file(dirs, '', 'memory.current'))
+        stats['memory']['limit_bytes'] = cgroup_int(read_cgroup_file(dirs, '', 'memory.max'))
+
+    if 'blkio' in dirs:
+        text = (read_cgroup_file(dirs, 'blkio', 'blkio.throttle.io_service_bytes')
+                or read_cgroup_file(dirs, 'blkio', 'blkio.io_service_bytes'))
+        if text is not None:
+            stats['blkio'] = {'read_bytes': 0, 'write_bytes': 0}
+            for line in text.splitlines():
+                parts = line.split()
+                if len(parts) == 3 and parts[1] in ('Read', 'Write'):
+                    stats['blkio'][parts[1].lower() + '_bytes'] += int(parts[2])
+    else:
+        text = read_cgroup_file(dirs, '', 'io.stat')
+        if text is not None:
+            stats['blkio'] = {'read_bytes': 0, 'write_bytes': 0}
+            for line in text.splitlines():
+                for field in line.split()[1:]:
+                    key, sep, value = field.partition('=')
+                    if key in ('rbytes', 'wbytes'):
+                        stats['blkio'][{'rbytes': 'read_bytes', 'wbytes': 'write_bytes'}[key]] += int(value)
+    return stats
+
+
+def container_stats(name, init_pid):
+    """ Stats of a container, named and timestamped """
+    retval = {'name': name, 'init_pid': init_pid, 'time': time.time()}
+    retval.update(cgroup_stats(init_pid))
+    return retval
+
+
+@route(PREFIX + '/containers/:name/stats', method='GET')
+def get_container_stats(name):
+    return container_stats(name, get_container_object(name).init_pid)
+
+DOC_API["apis"].append(DOC_API_CONTAINER_STATS)
+
+
+DOC_API_STATS = {
+            "description": "Containers stats",
+            "operations": [],
+            "path": "/stats",
+            "summary":"Resources usage of all the containers",
+            "notes": "",
+            "errorResponses":[]}
+
+DOC_API_STATS['operations'].append({
+            "httpMethod":"GET",
+            "nickname":"getStats",
+            "responseClass":"void",
+            "parameters":[{
+                "name":"fresh",
+                "allowMultiple": False,
+                "dataType": "boolean",
+                "description": "1 to read the init pids now instead of using the snapshot",
+                "paramType": "query",
+                "required": False
+                }],
+            "summary":"Get the stats of all the running containers at once",
+            "notes": "init pids come from the states snapshot, usages from the cgroup filesystem: no lxc call",
+            "errorResponses":[]
+                      })
+
+@route(PREFIX + '/stats', method='GET')
+def get_stats():
+    snapshot = get_snapshot(fresh=request.query.get('fresh') == '1')
+    return {'stats': [container_stats(entry['name'], entry['init_pid'])
+                      for entry in snapshot['containers']
+                      if entry['init_pid'] is not None and entry['init_pid'] > 0],
+            'snapshot_age': time.time() - snapshot['time']}
+
+DOC_API["apis"].append(DOC_API_STATS)
+
+
+""" 
+    Host capacity and admission control
+"""
+DOC_API_HOST_CAPACITY = {
+            "description": "Host capacity",
+            "operations": [],
+            "path": "/host/capacity",
+            "summary":"Host budgets and what the containers commit of them",
+            "notes": "",
+            "errorResponses":[]}
+
+DOC_API_HOST_CAPACITY['operations'].append({
+            "httpMethod":"GET",
+            "nickname":"getHostCapacity",
+            "responseClass":"void",
+            "parameters":[],
+            "summary":"Get the memory (bytes), cpu (cpus) and disk (bytes) headroom of the host",
+            "notes": "committed memory and cpu are the cgroup limits of the running containers, reserved what the admitted jobs will commit. With --admission, starts, restarts, unfreezes and creates not fitting in the headroom wait in a queue, 503 when it is full",
+            "errorResponses":[]
+                      })
+
+
+def container_needs(name):
+    """ {memory, cpu} committed by a container when running, from its cgroup limits """
+    lock = container_lock(name)
+    if lock.acquire(timeout=SNAPSHOT_LOCK_TIMEOUT):
+        try:
+            conf = cached_config(name, get_container_object(name))['conf']
+        finally:
+            lock.release()
+    else:
+        #busy, last parsed conf
+        conf = CONFIGS.get(name, {}).get('conf', {})
+    cgroups = configured_cgroups(conf)
+
+    def last(key):
+        values = conf_values(cgroups.get(key))
+        return values[-1] if values else None
+
+    memory = cgroup_int(last('memory.limit_in_bytes'))
+    if memory is None or memory <= 0:
+        memory = ADMISSION_DEFAULT_MEMORY
+    cpus = ADMISSION_DEFAULT_CPUS
+    quota = cgroup_int(last('cpu.cfs_quota_us'))
+    if last('cpuset.cpus'):
+        cpus = 0
+        for cpu_range in last('cpuset.cpus').split(','):
+            first, sep, end = cpu_range.partition('-')
+            cpus += int(end) - int(first) + 1 if sep else 1
+    elif quota is not None and quota > 0:
+        cpus = float(quota) / (cgroup_int(last('cpu.cfs_period_us')) or 100000)
+    return {'memory': memory, 'cpu': cpus}
+
+
+def committed_resources(snapshot):
+    """ {memory, cpu} committed by the running containers, disk used """
+    if COMMITTED['snapshot'] is not snapshot:
+        resources = {'memory': 0, 'cpu': 0}
+        for entry in snapshot['containers']:
+            if entry['state'] in ('STARTING', 'RUNNING', 'FREEZING', 'FROZEN', 'THAWED'):
+                for resource, value in container_needs(entry['name']).items():
+                    resources[resource] += value
+        COMMITTED['snapshot'], COMMITTED['resources'] = snapshot, resources
+    resources = dict(COMMITTED['resources'])
+    total, resources['disk'] = disk_usage()
+    return resources
+
+
+def disk_usage():
+    """ (total, used) bytes of the filesystem of the containers """
+    path = getattr(lxc, 'default_config_path', '/var/lib/lxc')
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    st = os.statvfs(path)
+    return st.f_blocks * st.f_frsize, (st.f_blocks - st.f_bavail) * st.f_frsize
+
+
+def host_budgets():
+    """ {memory, cpu, disk} the containers may commit """
+    memory = ADMISSION_MEMORY
+    if memory is None:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemTotal:'):
+                    memory = int(line.split()[1]) * 1024
+    total, used = disk_usage()
+    return {'memory': memory,
+            'cpu': ADMISSION_CPUS or os.cpu_count() or 1,
+            'disk': total - ADMISSION_DISK_RESERVE}
+
+
+def host_capacity(snapshot, committed, budgets):
+    """ {resource: {budget, committed, reserved, headroom}}, ADMISSION_LOCK held
+
+    Reservations are forgotten once a snapshot taken after the end of
+    their job counts what they committed
+    """
+    ADMISSION_RESERVATIONS[:] = [reservation for reservation in ADMISSION_RESERVATIONS
+                                 if reservation['done'] is None
+                                 or reservation['done'] >= snapshot['time']]
+    capacity = {}
+    for resource in ('memory', 'cpu', 'disk'):
+        reserved = sum(reservation['needs'].get(resource, 0)
+                       for reservation in ADMISSION_RESERVATIONS)
+        capacity[resource] = {'budget': budgets[resource],
+                              'committed': committed[resource],
+                              'reserved': reserved,
+                              'headroom': budgets[resource] - committed[resource] - reserved}
+    return capacity
+
+
+def reserve(needs, capacity):
+    """ Reservation of needs if they fit in the headroom, None otherwise; ADMISSION_LOCK held """
+    for resource, value in needs.items():
+        if value > capacity[resource]['headroom']:
+            return None
+        capacity[resource]['reserved'] += value
+        capacity[resource]['headroom'] -= value
+    reservation = {'needs': needs, 'done': None}
+    ADMISSION_RESERVATIONS.append(reservation)
+    return reservation
+
+
+def reserve_now(needs):
+    """ Reservation of needs, None if the host has no room for them
+
+    Queued jobs too large for the headroom do not hold back smaller needs
+    """
+    snapshot = get_snapshot()
+    committed, budgets = committed_resources(snapshot), host_budgets()
+    with ADMISSION_LOCK:
+        return reserve(needs, host_capacity(snapshot, committed, budgets))
+
+
+def release_reservation(reservation):
+    """ The reserved resources are now committed, or the action failed """
+    with ADMISSION_LOCK:
+        reservation['done'] = time.time()
+    invalidate_snapshot()
+
+
+def run_admitted(reservation, func, args):
+    """ Job body of an admitted job, its reservation held until it is done """
+    try:
+        return func(*args)
+    finally:
+        release_reservation(reservation)
+
+
+def submit_admitted_job(action, name, needs, func, *args):
+    """ submit_job() if the host has room for needs
+
+    Otherwise the job waits in the admission queue, 503 if it is full
+    """
+    if not ADMISSION:
+        return submit_job(action, name, func, *args)
+    action_limit(action).admit()
+    snapshot = get_snapshot()
+    committed, budgets = committed_resources(snapshot), host_budgets()
+    with ADMISSION_LOCK:
+        reservation = None
+        if not ADMISSION_QUEUE:
+            reservation = reserve(needs, host_capacity(snapshot, committed, budgets))
+        if reservation is None and len(ADMISSION_QUEUE) >= ADMISSION_QUEUE_SIZE:
+            action_limit(action).cancel()
+            inc_metric('lxc_restapi_admission_rejected_total', (('action', action), ))
+            abort_retry(503, 'Not enough room on the host and %d jobs waiting for it' % len(ADMISSION_QUEUE),
+                        ADMISSION_RETRY_AFTER)
+        job = new_job(action, name)
+        if reservation is None:
+            job['waiting'] = 'capacity'
+            ADMISSION_QUEUE.append((job, needs, func, args))
+        else:
+            get_job_executor(action).submit(run_job, job, run_admitted, (reservation, func, args))
+    return job
+
+
+def drain_admission():
+    """ Submit the waiting jobs the host now has room for, in order
+
+    Jobs waiting for more than ADMISSION_TIMEOUT fail
+    """
+    if not ADMISSION_QUEUE:
+        return
+    snapshot = get_snapshot()
+    committed, budgets = committed_resources(snapshot), host_budgets()
+    with ADMISSION_LOCK:
+        capacity = host_capacity(snapshot, committed, budgets)
+        while ADMISSION_QUEUE:
+            job, needs, func, args = ADMISSION_QUEUE[0]
+            if time.time() - job['created'] > ADMISSION_TIMEOUT:
+                ADMISSION_QUEUE.popleft()
+                action_limit(job['action']).cancel()
+                with JOBS_LOCK:
+                    job['status'] = 'failed'
+                    job['error'] = 'no room on the host after %ss' % ADMISSION_TIMEOUT
+                    job['finished'] = time.time()
+                    job['waiting'] = None
+                inc_metric('lxc_restapi_jobs_total', (('action', job['action']), ('status', 'failed')))
+                continue
+            reservation = reserve(needs, capacity)
+            if reservation is None:
+                break
+            ADMISSION_QUEUE.popleft()
+            with JOBS_LOCK:
+                job['waiting'] = None
+            get_job_executor(job['action']).submit(run_job, job, run_admitted, (reservation, func, args))
+
+
+@route(PREFIX + '/host/capacity', method='GET')
+def get_host_capacity():
+    snapshot = get_snapshot()
+    committed, budgets = committed_resources(snapshot), host_budgets()
+    with ADMISSION_LOCK:
+        retval = host_capacity(snapshot, committed, budgets)
+        retval['admission'] = ADMISSION
+        retval['waiting'] = len(ADMISSION_QUEUE)
+    return retval
+
+DOC_API["apis"].append(DOC_API_HOST_CAPACITY)
+
+
+@route(PREFIX + '/containers/:name/ips', method='GET')
+#get container ips addresses
+def get_container_ip(name):
+    retval = {}
+    with container_lock(name):
+        container = get_container_object(name)
+        retval['ips'] = lookup_ips(name, container, container.state, timeout=10)
+    return retval
+
+
+""" 
+    Container's wait
+"""
+DOC_API_CONTAINER_WAIT = {
+            "description": "Container wait",
+            "operations": [],
+            "path": "/containers/{name}/wait",
+            "summary":"Wait for a container state",
+            "notes": "",
+            "errorResponses":[]}
+
+DOC_API_CONTAINER_WAIT['operations'].append({
+            "httpMethod":"GET",
+            "nickname":"waitContainer",
+            "responseClass":"void",
+            "parameters":[{
+                "name":"name",
+                "allowMultiple": False,
+                "dataType": "string",
+                "description": "container name",
+                "paramType": "path",
+                "required": True
+                },{
+                "name":"state",
+                "allowMultiple": False,
+                "dataType": "string",
+                "description": "state to wait for",
+                "paramType": "query",
+                "required": False,
+                "allowableValues":{
+                        "valueType":"LIST",
+                        "values": sorted(ACTIONS_BY_STATE)
+                                   }
+                },{
+                "name":"ips",
+                "allowMultiple": False,
+                "dataType": "boolean",
+                "description": "1 to wait for the container to have ip addresses",
+                "paramType": "query",
+                "required": False
+                },{
+                "name":"timeout",
+                "allowMultiple": False,
+                "dataType": "float",
+                "description": "seconds to wait (default: 60, max: %s, %s with --server wsgiref)" % (
+                                        WAIT_MAX_TIMEOUT, WAIT_SINGLE_THREADED_TIMEOUT),
+                "paramType": "query",
+                "required": False
+                }],
+            "summary":"Return when the container is in state (and has ips) or after timeout",
+            "notes": "reached is false on timeout, call again to wait more; waiters sleep on the events log, they do not call lxc",
+            "errorResponses":[{"code": 400, "reason": "Unknown state or timeout not a number"},
+                              {"code": 404, "reason": "Unknown container"}]
+                      })
+
+def container_exists(name):
+    """ True if lxc knows the container, without asking it when the
+    snapshot lists it
+    """
+    with SNAPSHOT_LOCK:
+        snapshot = SNAPSHOT
+    return (any(item['name'] == name for item in snapshot['containers'])
+            or name in list_containers())
+
+
+def snapshot_status(name):
+    """ (state, ips) of a container in the current snapshot """
+    with SNAPSHOT_LOCK:
+        snapshot = SNAPSHOT
+    state = None
+    for item in snapshot['containers']:
+        if item['name'] == name:
+            state = item['state']
+    return state, snapshot['ips'].get(name, [])
+
+
+@route(PREFIX + '/containers/:name/wait', method='GET')
+def wait_container(name):
+    state = request.query.get('state')
+    if state is not None and state not in ACTIONS_BY_STATE:
+        abort(400, 'Unknown state %s' % state)
+    want_ips = request.query.get('ips') == '1'
+    timeout = min(number_param(request.query.get('timeout', 60), float, 'timeout'),
+                  WAIT_SINGLE_THREADED_TIMEOUT if SINGLE_THREADED else WAIT_MAX_TIMEOUT)
+    if not container_exists(name):
+        abort(404, 'Unknown container %s' % name)
+
+    started = time.time()
+    since = EVENT_ID
+    get_snapshot()
+    while True:
+        current_state, ips = snapshot_status(name)
+        reached = ((state is None or current_state == state)
+                   and (not want_ips or len(ips) > 0))
+        remaining = started + timeout - time.time()
+        if reached or remaining <= 0:
+            break
+        events, since = get_events(since, name, remaining)
+    return {'name': name,
+            'state': current_state,
+            'ips': ips,
+            'reached': reached,
+            'waited': time.time() - started}
+
+DOC_API["apis"].append(DOC_API_CONTAINER_WAIT)
+
+""" 
+    Container's actions
+"""
+DOC_API_CONTAINER_ACTIONS = {
+            "description": "Container actions",
+            "operations": [],
+            "path": "/containers/{name}/actions/{action}",
+            "summary":"Container item manipulation",
+            "notes": "",
+            "errorResponses":[]}
+
+"""PUT on container """
+DOC_API_CONTAINER_ACTIONS['operations'].append({
+            "httpMethod":"POST",
+            "nickname":"putContainer",
+            "responseClass":"void",
+            "parameters":[{
+                "name":"name",
+                "allowMultiple": False,
+                "dataType": "string",
+                "description": "container name",
+                "paramType": "path",
+                "required": True
+                },{
+                "name":"action",
+                "allowMultiple": False,
+                "dataType": "string",
+                "description": "container action to perform",
+                "paramType": "path",
+                "required": True,
+                "allowableValues":{
+                        "valueType":"LIST",
+                        "values":[
+                                  "start",
+                                  "stop",
+                                  "shutdown",
+                                  "restart",
+                                  "freeze",
+                                  "unfreeze",
+                                  "chrootcmd",
+                                  "destroy",
+                                  "clone",
+                                  "attach"
+                                  ]
+                                   }
+                },{
+                "name":"cmd",
+                "allowMultiple": False,
+                "dataType": "string",
+                "description": "for chrootcmd and attach, the command to execute",
+                "paramType": "body",
+                "required": False
+                },{
+                "name":"clone",
+                "allowMultiple": False,
+                "dataType": "string",
+                "description": "for clone, {name: new name, snapshot: true for copy-on-write, bdevtype: overlayfs|btrfs|lvm|dir, conf: [keyval]}",
+                "paramType": "body",
+                "required": False
+                }
+                ],
+            "summary":"perform {action} on a container",
+            "notes": "start, stop, shutdown, restart, freeze, unfreeze and clone are queued: 202 and a job, see /jobs/{id}",
+            "errorResponses":[]
+                      })
+
+
+def start_container(name):
+    with container_lock(name):
+        container = get_container_object(name)
+        if not container.start():
+            abort(500, 'container.start() failed')
+        container.wait("RUNNING", 3)
+
+
+def shutdown_container(name):
+    with container_lock(name):
+        container = get_container_object(name)
+        if not container.shutdown(timeout=10):
+            abort(500, 'container.shutdown() failed')
+    close_sessions(name)
+
+
+def stop_container(name):
+    with container_lock(name):
+        container = get_container_object(name)
+        if not container.stop():
+            abort(500, 'container.shutdown() failed')
+        container.wait("STOPPED", 10)
+    close_sessions(name)
+
+
+def restart_container(name):
+    with container_lock(name):
+        shutdown_container(name)
+        stop_container(name)
+        start_container(name)
+
+
+def freeze_container(name):
+    with container_lock(name):
+        container = get_container_object(name)
+        if not container.freeze():
+            abort(500, 'container.freeze() failed')
+        container.wait("FROZEN", 10)
+
+
+def unfreeze_container(name):
+    with container_lock(name):
+        container = get_container_object(name)
+        if not container.unfreeze():
+            abort(500, 'container.unfreeze() failed')
+        container.wait("RUNNING", 10)
+
+
+@route(PREFIX + '/containers/:name/actions/start', method='POST')
+#start it
+def post_start_container(name):
+    needs = container_needs(name) if ADMISSION else None
+    return job_accepted(submit_admitted_job('start', name, needs, start_container, name))
+
+
+@route(PREFIX + '/containers/:name/actions/shutdown', method='POST')
+#shut it down
+def post_shutdown_container(name):
+    return job_accepted(submit_job('shutdown', name, shutdown_container, name))
+
+
+@route(PREFIX + '/containers/:name/actions/stop', method='POST')
+#shut it down
+def post_stop_container(name):
+    return job_accepted(submit_job('stop', name, stop_container, name))
+
+
+@route(PREFIX + '/containers/:name/actions/restart', method='POST')
+#restart it
+def post_restart_container(name):
+    needs = container_needs(name) if ADMISSION else None
+    return job_accepted(submit_admitted_job('restart', name, needs, restart_container, name))
+
+
+@route(PREFIX + '/containers/:name/actions/freeze', method='POST')
+#freeze it
+def post_freeze_container(name):
+    return job_accepted(submit_job('freeze', name, freeze_container, name))
+
+
+@route(PREFIX + '/containers/:name/actions/unfreeze', method='POST')
+#unfreeze it
+def post_unfreeze_container(name):
+    needs = container_needs(name) if ADMISSION else None
+    return job_accepted(submit_admitted_job('unfreeze', name, needs, unfreeze_container, name))
+
+
+def destroy_container(name):
+    container = get_container_object(name)
+    with container_lock(name):
+        if not container.destroy():
+            abort(500, 'container.destroy() failed')
+        CONFIGS.pop(name, None)
+        PROBED_IPS.pop(name, None)
+        index_delete(name)
+    close_sessions(name)
+    invalidate_snapshot()
+
+
+@route(PREFIX + '/containers/:name/actions/destroy', method='POST')
+#destroy it
+def post_destroy_container(name):
+    with action_limit('destroy').slot():
+        destroy_container(name)
+
+    
+@route(PREFIX + '/containers/:name/actions/chrootcmd', method='POST')
+def chrootcmd(name):
+    """
+    Exec a command in container "name" with chroot
+    example:
+        input : {'cmd':'ls /'}
+        returns : {'output':'bin  boot  dev  etc  home ... usr  var'}
+    """
+    data = request.json
+    if len(data) == 0:
+        abort(400, 'No data received')
+
+    container = get_container_object(name)
+    cmd = chroot_command(container, data['cmd'])
+
+    output = subprocess.check_output(cmd)
+    retval = {}
+    retval['output'] = output.decode('utf-8', 'replace')
+    return retval
+
+    ##fork and chroot
+    #r, w = os.pipe()
+    #pid = os.fork()
+    #if pid:
+        #os.close(w)
+        #r = os.fdopen(r)
+        #print("chrootexec child forked")
+        #txt = r.read()
+        #os.waitpid(pid, 0)
+    #else:
+        #os.close(r)
+        #w = os.fdopen(w, 'w')
+        #print("chrooting into %s" % rootfs)
+        #os.chroot("%s" % rootfs)
+        #print("executing %s" % data['cmd'])
+        #output = subprocess.check_output(data['cmd'], shell=True)
+        #w.write("%s" % output)
+        #w.close()
+        #print("child: closing")
+        #os._exit(0)
+    #retval = {}
+    #retval['output'] = txt
+    #return retval
 
 
 @route(PREFIX + '/containers/:name/actions/attach', method='POST')
 #exec a command in it with attach
 def chrootattach(name):
     data = request.json
-    if len(data) == 0:
+    if len(data) == 0:
+        abort(400, 'No data received')
+
+    container = get_container_object(name)
+    if not container.running:
+        return False
+
+    attach = attach_command(name, container, data['namespaces'], data['cmd'])
+
+    if subprocess.call(
+            attach,
+            universal_newlines=True) != 0:
+        return False
+    return True
+
+
+def chroot_command(container, cmd):
+    """ argv running cmd (string or list) chrooted in the container rootfs
+
+    409 unless the rootfs is a directory: the upper directory of an
+    overlayfs snapshot only holds the changed files, a block device
+    has to be mounted first
+    """
+    if isinstance(cmd, str):
+        cmd = shlex.split(cmd)
+    rootfs = container.get_config_item('lxc.rootfs')
+    bdev, sep, path = rootfs.partition(':')
+    if not sep:
+        bdev, path = 'dir', rootfs
+    if bdev != 'dir' or path.startswith('/dev/'):
+        abort(409, 'chroot needs a dir rootfs, %s is %s: use attach mode' % (container.name, rootfs))
+    return ['chroot', path] + list(cmd)
+
+
+def attach_command(name, container, namespaces, cmd):
+    """ argv running cmd (string or list) with lxc-attach, namespaces
+    is ALL or a lxc-attach -s list like NETWORK|UTSNAME
+    """
+    if isinstance(cmd, str):
+        cmd = shlex.split(cmd)
+    attach = ["lxc-attach", "-n", name,
+              "-P", container.get_config_path()]
+    if namespaces != "ALL":
+        attach += ["-s", namespaces]
+    if cmd:
+        attach += ["--"] + list(cmd)
+    return attach
+
+
+def stream_process(process, stdin):
+    """ Generator of (stream, data) while process runs, then ('exit', code)
+
+    stdout and stderr are read by two threads so that neither blocks
+    the other, stdin is written by a third one
+    """
+    chunks = queue.Queue()
+
+    def reader(stream, pipe):
+        #a character may be split between two chunks
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        for data in iter(lambda: pipe.read1(EXEC_CHUNK), b''):
+            text = decoder.decode(data)
+            if text:
+                chunks.put((stream, text))
+        text = decoder.decode(b'', final=True)
+        if text:
+            chunks.put((stream, text))
+        chunks.put((stream, None))
+
+    def writer():
+        try:
+            if stdin:
+                process.stdin.write(stdin.encode('utf-8'))
+        except (IOError, OSError):
+            pass
+        finally:
+            process.stdin.close()
+
+    threads = [threading.Thread(target=reader, args=('stdout', process.stdout)),
+               threading.Thread(target=reader, args=('stderr', process.stderr)),
+               threading.Thread(target=writer)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    running = 2
+    while running:
+        stream, data = chunks.get()
+        if data is None:
+            running -= 1
+        else:
+            yield stream, data
+    yield 'exit', process.wait()
+
+
+def stream_exec(argv, stdin, sse):
+    """ Body of /exec: ndjson lines or Server-Sent Events """
+    try:
+        process = subprocess.Popen(argv, stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError as e:
+        EXEC_SLOTS.release()
+        abort(500, 'exec of %s failed: %s' % (argv[0], e))
+
+    def body():
+        try:
+            for stream, data in stream_process(process, stdin):
+                if stream == 'exit':
+                    item = {'exit_code': data}
+                else:
+                    item = {'stream': stream, 'data': data}
+                if sse:
+                    yield "event: %s\ndata: %s\n\n" % (stream, json.dumps(item))
+                else:
+                    yield json.dumps(item) + "\n"
+        finally:
+            #client gone: do not leave the command running
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            EXEC_SLOTS.release()
+    return body()
+
+
+""" 
+    Container's exec
+"""
+DOC_API_CONTAINER_EXEC = {
+            "description": "Container exec",
+            "operations": [],
+            "path": "/containers/{name}/exec",
+            "summary":"Streaming command execution",
+            "notes": "",
+            "errorResponses":[]}
+
+DOC_API_CONTAINER_EXEC['operations'].append({
+            "httpMethod":"POST",
+            "nickname":"execContainer",
+            "responseClass":"void",
+            "parameters":[{
+                "name":"name",
+                "allowMultiple": False,
+                "dataType": "string",
+                "description": "container name",
+                "paramType": "path",
+                "required": True
+                },{
+                "name":"cmd",
+                "allowMultiple": False,
+                "dataType": "string",
+                "description": "{cmd: command (string or list), mode: attach (default) or chroot, namespaces: ALL (default) or NETWORK|UTSNAME..., stdin: data to send to the command}",
+                "paramType": "body",
+                "required": True
+                }],
+            "summary":"Exec a command in the container and stream its output",
+            "notes": "the body is streamed as json lines {stream: stdout|stderr, data} then {exit_code}; with Accept: text/event-stream as Server-Sent Events; at most %s sessions at once" % EXEC_MAX,
+            "errorResponses":[{"code": 429, "reason": "Too many exec sessions"},
+                              {"code": 409, "reason": "attach needs a running container, chroot a dir rootfs"}]
+                      })
+
+@route(PREFIX + '/containers/:name/exec', method='POST')
+def exec_container(name):
+    data = request.json
+    if not data or not data.get('cmd'):
+        abort(400, 'No cmd received')
+    mode = data.get('mode', 'attach')
+    if mode not in ('attach', 'chroot'):
+        abort(400, 'Unknown mode %s' % mode)
+
+    container = get_container_object(name)
+    with container_lock(name):
+        if mode == 'chroot':
+            argv = chroot_command(container, data['cmd'])
+        elif not container.running:
+            abort(409, 'attach needs %s RUNNING' % name)
+        else:
+            argv = attach_command(name, container, data.get('namespaces', 'ALL'), data['cmd'])
+
+    if not EXEC_SLOTS.acquire(False):
+        abort_retry(429, 'Too many exec sessions', 1)
+    sse = 'text/event-stream' in request.get_header('Accept', '')
+    response.content_type = 'text/event-stream' if sse else 'application/x-ndjson'
+    return stream_exec(argv, data.get('stdin'), sse)
+
+DOC_API["apis"].append(DOC_API_CONTAINER_EXEC)
+
+""" 
+    Container's exec sessions
+"""
+class ExecSession(object):
+    """ Shell kept attached in a container, runs commands one after another
+
+    Each command is followed by a marker echoed on stdout (with the exit
+    code) and on stderr, the output of the command is what comes before
+    """
+
+    def __init__(self, name, mode, argv):
+        self.id = str(uuid.uuid4())
+        self.container = name
+        self.mode = mode
+        self.created = time.time()
+        self.last_used = self.created
+        self.commands = 0
+        self.lock = threading.Lock()
+        self.condition = threading.Condition()
+        self.buffers = {'stdout': bytearray(), 'stderr': bytearray()}
+        self.truncated = {'stdout': False, 'stderr': False}
+        self.eof = False
+        try:
+            self.process = subprocess.Popen(argv, stdin=subprocess.PIPE,
+                                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except OSError as e:
+            #not registered yet: nothing to clean up
+            abort(500, 'exec of %s failed: %s' % (argv[0], e))
+        for stream in ('stdout', 'stderr'):
+            thread = threading.Thread(target=self.reader,
+                                      args=(stream, getattr(self.process, stream)))
+            thread.daemon = True
+            thread.start()
+
+    def reader(self, stream, pipe):
+        for data in iter(lambda: pipe.read1(EXEC_CHUNK), b''):
+            with self.condition:
+                buffer = self.buffers[stream]
+                buffer += data
+                if len(buffer) > SESSION_OUTPUT_MAX:
+                    #the end marker comes last, only the oldest output is lost
+                    del buffer[:len(buffer) - SESSION_OUTPUT_MAX]
+                    self.truncated[stream] = True
+                self.condition.notify_all()
+        with self.condition:
+            self.eof = True
+            self.condition.notify_all()
+
+    def run(self, cmd, timeout):
+        """ {output, stderr, exit_code, truncated, duration} of cmd run by the shell """
+        with self.lock:
+            started = time.time()
+            mark = ("__lxc_restapi_%s__" % uuid.uuid4().hex).encode('utf-8')
+            script = b"{ " + cmd.encode('utf-8') + b"\n} </dev/null\n" \
+                     b"printf '\\n%s %d\\n' " + mark + b" $?\n" \
+                     b"printf '\\n%s\\n' " + mark + b" >&2\n"
+            try:
+                self.process.stdin.write(script)
+                self.process.stdin.flush()
+            except (IOError, OSError):
+                self.close()
+                abort(410, 'exec session %s is closed' % self.id)
+            out_mark, err_mark = b"\n" + mark + b" ", b"\n" + mark + b"\n"
+            with self.condition:
+                while True:
+                    out_end = self.buffers['stdout'].find(out_mark)
+                    err_end = self.buffers['stderr'].find(err_mark)
+                    code_end = self.buffers['stdout'].find(b"\n", out_end + len(out_mark))
+                    if out_end >= 0 and err_end >= 0 and code_end >= 0:
+                        break
+                    remaining = started + timeout - time.time()
+                    if self.eof or remaining <= 0:
+                        self.close()
+                        abort(504, 'exec session %s closed: command did not finish' % self.id)
+                    self.condition.wait(remaining)
+                stdout = bytes(self.buffers['stdout'])
+                stderr = bytes(self.buffers['stderr'])
+                del self.buffers['stdout'][:code_end + 1]
+                del self.buffers['stderr'][:err_end + len(err_mark)]
+                truncated = self.truncated['stdout'] or self.truncated['stderr']
+                self.truncated = {'stdout': False, 'stderr': False}
+            self.commands += 1
+            self.last_used = time.time()
+            return {'output': stdout[:out_end].decode('utf-8', 'replace'),
+                    'stderr': stderr[:err_end].decode('utf-8', 'replace'),
+                    'exit_code': int(stdout[out_end + len(out_mark):code_end]),
+                    'truncated': truncated,
+                    'duration': self.last_used - started}
+
+    def close(self):
+        with SESSIONS_LOCK:
+            SESSIONS.pop(self.id, None)
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+
+    def view(self):
+        return {'id': self.id,
+                'container': self.container,
+                'mode': self.mode,
+                'created': self.created,
+                'last_used': self.last_used,
+                'commands': self.commands}
+
+
+def get_session(name, session_id):
+    with SESSIONS_LOCK:
+        session = SESSIONS.get(session_id)
+    if session is None or session.container != name:
+        abort(404, 'Unknown exec session %s' % session_id)
+    return session
+
+
+def close_sessions(name):
+    """ Close the exec sessions of a stopped or destroyed container """
+    with SESSIONS_LOCK:
+        sessions = [session for session in SESSIONS.values() if session.container == name]
+    for session in sessions:
+        session.close()
+
+
+def session_reaper():
+    """ Close the sessions idle for more than SESSION_IDLE_TIMEOUT """
+    while True:
+        time.sleep(min(SESSION_IDLE_TIMEOUT / 4.0, 10))
+        with SESSIONS_LOCK:
+            sessions = list(SESSIONS.values())
+        for session in sessions:
+            if (not session.lock.locked()
+                    and time.time() - session.last_used > SESSION_IDLE_TIMEOUT):
+                session.close()
+
+
+def start_session_reaper():
+    thread = threading.Thread(target=session_reaper, name="sessions")
+    thread.daemon = True
+    thread.start()
+
+
+DOC_API_CONTAINER_SESSIONS = {
+            "description": "Container exec sessions",
+            "operations": [],
+            "path": "/containers/{name}/sessions",
+            "summary":"Shells kept attached in a container",
+            "notes": "",
+            "errorResponses":[]}
+
+DOC_API_CONTAINER_SESSIONS['operations'].append({
+            "httpMethod":"GET",
+            "nickname":"getSessions",
+            "responseClass":"void",
+            "parameters":[{
+                "name":"name",
+                "allowMultiple": False,
+                "dataType": "string",
+                "description": "container name",
+                "paramType": "path",
+                "required": True
+                }],
+            "summary":"Get the exec sessions of the container",
+            "notes": "",
+            "errorResponses":[]
+                      })
+
+DOC_API_CONTAINER_SESSIONS['operations'].append({
+            "httpMethod":"POST",
+            "nickname":"newSession",
+            "responseClass":"void",
+            "parameters":[{
+                "name":"name",
+                "allowMultiple": False,
+                "dataType": "string",
+                "description": "container name",
+                "paramType": "path",
+                "required": True
+                },{
+                "name":"session",
+                "allowMultiple": False,
+                "dataType": "string",
+                "description": "{mode: attach (default) or chroot, namespaces: ALL (default) or NETWORK|UTSNAME...}",
+                "paramType": "body",
+                "required": False
+                }],
+            "summary":"Attach a shell in the container",
+            "notes": "at most %s sessions per container, closed after %s s idle" % (SESSIONS_PER_CONTAINER, SESSION_IDLE_TIMEOUT),
+            "errorResponses":[{"code": 429, "reason": "Too many sessions for this container"},
+                              {"code": 409, "reason": "attach needs a running container, chroot a dir rootfs"}]
+                      })
+
+@route(PREFIX + '/containers/:name/sessions', method='GET')
+def get_session_list(name):
+    with SESSIONS_LOCK:
+        sessions = [session.view() for session in SESSIONS.values()
+                    if session.container == name]
+    return {'sessions': sessions}
+
+
+@route(PREFIX + '/containers/:name/sessions', method='POST')
+def add_session(name):
+    data = request.json or {}
+    mode = data.get('mode', 'attach')
+    if mode not in ('attach', 'chroot'):
+        abort(400, 'Unknown mode %s' % mode)
+    with SESSIONS_LOCK:
+        count = len([session for session in SESSIONS.values()
+                     if session.container == name])
+        if count + SESSIONS_STARTING.get(name, 0) >= SESSIONS_PER_CONTAINER:
+            abort_retry(429, 'Too many exec sessions for %s' % name, SESSION_IDLE_TIMEOUT)
+        SESSIONS_STARTING[name] = SESSIONS_STARTING.get(name, 0) + 1
+
+    try:
+        container = get_container_object(name)
+        with container_lock(name):
+            if mode == 'chroot':
+                argv = chroot_command(container, ['/bin/sh'])
+            elif not container.running:
+                abort(409, 'attach needs %s RUNNING' % name)
+            else:
+                argv = attach_command(name, container, data.get('namespaces', 'ALL'), ['/bin/sh'])
+        session = ExecSession(name, mode, argv)
+        with SESSIONS_LOCK:
+            SESSIONS[session.id] = session
+    finally:
+        with SESSIONS_LOCK:
+            SESSIONS_STARTING[name] -= 1
+            if not SESSIONS_STARTING[name]:
+                del SESSIONS_STARTING[name]
+    response.status = 201
+    response.set_header('Location', "%s/containers/%s/sessions/%s" % (PREFIX, name, session.id))
+    return session.view()
+
+DOC_API["apis"].append(DOC_API_CONTAINER_SESSIONS)
+
+DOC_API_CONTAINER_SESSION = {
+            "description": "Container exec session",
+            "operations": [],
+            "path": "/containers/{name}/sessions/{id}",
+            "summary":"Commands run by an attached shell",
+            "notes": "",
+            "errorResponses":[]}
+
+DOC_API_CONTAINER_SESSION['operations'].append({
+            "httpMethod":"POST",
+            "nickname":"execSession",
+            "responseClass":"void",
+            "parameters":[{
+                "name":"name",
+                "allowMultiple": False,
+                "dataType": "string",
+                "description": "container name",
+                "paramType": "path",
+                "required": True
+                },{
+                "name":"id",
+                "allowMultiple": False,
+                "dataType": "string",
+                "description": "session id",
+                "paramType": "path",
+                "required": True
+                },{
+                "name":"cmd",
+                "allowMultiple": False,
+                "dataType": "string",
+                "description": "{cmd: shell command line, timeout: seconds (default: 60)}",
+                "paramType": "body",
+                "required": True
+                }],
+            "summary":"Run a command in the session shell, path is /containers/{name}/sessions/{id}/exec",
+            "notes": "returns {output, stderr, exit_code, truncated, duration}, truncated if the command wrote more than %s bytes on stdout or stderr: only the last ones are kept; the command gets /dev/null as stdin, the session is closed if it times out" % SESSION_OUTPUT_MAX,
+            "errorResponses":[{"code": 400, "reason": "cmd not a string or timeout not a number"},
+                              {"code": 404, "reason": "Unknown session"},
+                              {"code": 504, "reason": "Command timed out, session closed"}]
+                      })
+
+DOC_API_CONTAINER_SESSION['operations'].append({
+            "httpMethod":"DELETE",
+            "nickname":"delSession",
+            "responseClass":"void",
+            "parameters":[{
+                "name":"name",
+                "allowMultiple": False,
+                "dataType": "string",
+                "description": "container name",
+                "paramType": "path",
+                "required": True
+                },{
+                "name":"id",
+                "allowMultiple": False,
+                "dataType": "string",
+                "description": "session id",
+                "paramType": "path",
+                "required": True
+                }],
+            "summary":"Close the session shell",
+            "notes": "",
+            "errorResponses":[{"code": 404, "reason": "Unknown session"}]
+                      })
+
+@route(PREFIX + '/containers/:name/sessions/:session_id/exec', method='POST')
+def exec_session(name, session_id):
+    session = get_session(name, session_id)
+    data = request.json
+    if not data or not data.get('cmd') or not isinstance(data['cmd'], str):
+        abort(400, 'No cmd received, it must be a string')
+    return session.run(data['cmd'], number_param(data.get('timeout', 60), float, 'timeout'))
+
+
+@route(PREFIX + '/containers/:name/sessions/:session_id', method='DELETE')
+def delete_session(name, session_id):
+    get_session(name, session_id).close()
+
+DOC_API["apis"].append(DOC_API_CONTAINER_SESSION)
+
+
+def clone_container(name, newname, snapshot, bdevtype, conf):
+    """ Job: clone stopped container name as newname, returns its details
+
+    snapshot makes a copy-on-write clone (overlayfs, btrfs, lvm...)
+    """
+    first, second = sorted([name, newname])
+    with container_lock(first), container_lock(second):
+        container = get_container_object(name)
+        if container.state != "STOPPED":
+            abort(409, 'clone of %s needs it STOPPED' % name)
+        if newname in list_containers():
+            abort(409, 'container %s already exists' % newname)
+        if hasattr(lxc, 'LXC_CLONE_SNAPSHOT'):
+            flags = lxc.LXC_CLONE_SNAPSHOT if snapshot else 0
+            clone = container.clone(newname, flags=flags, bdevtype=bdevtype)
+            if clone:
+                clone = TimedContainer(clone)
+        else:
+            #lxc 0.9: the new container clones the existing one, full copy
+            clone = TimedContainer(lxc.Container(newname))
+            if not clone.clone(container.container):
+                clone = False
+        if not clone:
+            abort(500, 'container.clone() failed')
+        with CONTAINERS_LOCK:
+            CONTAINERS[newname] = clone
+        index_update(newname, template=INDEX_META.get(name, {}).get('template'),
+                     created=time.time())
+        if len(conf) > 0:
+            set_container_conf(clone, conf)
+        return container_details(newname)
+
+
+@route(PREFIX + '/containers/:name/actions/clone', method='POST')
+#clone it
+def post_clone_container(name):
+    data = request.json
+    if not data or 'name' not in data:
+        abort(400, 'No clone name received')
+    conf = {}
+    if 'conf' in data:
+        conf = keyval_list_to_dict(data['conf'])
+    return job_accepted(submit_job('clone', data['name'], clone_container,
+                                   name, data['name'], data.get('snapshot', False),
+                                   data.get('bdevtype'), conf))
+
+DOC_API["apis"].append(DOC_API_CONTAINER_ACTIONS)
+
+ACTION_HANDLERS = {'start': start_container,
+                   'stop': stop_container,
+                   'shutdown': shutdown_container,
+                   'restart': restart_container,
+                   'freeze': freeze_container,
+                   'unfreeze': unfreeze_container,
+                   'destroy': destroy_container}
+
+""" 
+    Bulk actions
+"""
+DOC_API_CONTAINERS_BULK_ACTIONS = {
+            "description": "Actions on many containers",
+            "operations": [],
+            "path": "/containers/actions/{action}",
+            "summary":"Container collection manipulation",
+            "notes": "",
+            "errorResponses":[]}
+
+DOC_API_CONTAINERS_BULK_ACTIONS['operations'].append({
+            "httpMethod":"POST",
+            "nickname":"bulkAction",
+            "responseClass":"void",
+            "parameters":[{
+                "name":"action",
+                "allowMultiple": False,
+                "dataType": "string",
+                "description": "action to perform on each container",
+                "paramType": "path",
+                "required": True,
+                "allowableValues":{
+                        "valueType":"LIST",
+                        "values": sorted(ACTION_HANDLERS)
+                                   }
+                },{
+                "name":"names",
+                "allowMultiple": True,
+                "dataType": "string",
+                "description": "names of the containers",
+                "paramType": "body",
+                "required": False
+                },{
+                "name":"pattern",
+                "allowMultiple": False,
+                "dataType": "string",
+                "description": "glob on the names of the containers, e.g. web-*",
+                "paramType": "body",
+                "required": False
+                }],
+            "summary":"perform {action} on many containers in parallel",
+            "notes": "queued: 202 and a bulk_{action} job, see /jobs/{id}; its result gives the status of each container. Containers whose state does not allow the action are skipped, each one waits for the rate and concurrency limits of the action. With --admission, starts, restarts and unfreezes not fitting in the host headroom are rejected",
+            "errorResponses":[{"code": 400, "reason": "names is not a list of names or pattern not a string"},
+                              {"code": 404, "reason": "Unknown action"}]
+                      })
+
+def bulk_action(action, name):
+    """ Run action on a container if its state allows it
+
+    Waits for a token and a running slot of the action, before taking
+    the lock
+    """
+    limit = action_limit(action)
+    limit.wait_token()
+    started = limit.start(queued=False)
+    try:
+        return locked_bulk_action(action, name)
+    finally:
+        limit.finish(started)
+
+
+def locked_bulk_action(action, name):
+    """ bulk_action() holding the container lock """
+    retval = {'name': name, 'status': 'done', 'error': None}
+    with container_lock(name):
+        state = get_container_object(name).state
+        if action not in ACTIONS_BY_STATE[state]:
+            retval['status'] = 'skipped'
+            retval['error'] = '%s not allowed in state %s' % (action, state)
+            return retval
+        reservation = None
+        if ADMISSION and action in ADMITTED_ACTIONS:
+            reservation = reserve_now(container_needs(name))
+            if reservation is None:
+                retval['status'] = 'rejected'
+                retval['error'] = 'not enough room on the host'
+                return retval
+        started = time.time()
+        try:
+            ACTION_HANDLERS[action](name)
+        except Exception as e:
+            retval['status'] = 'failed'
+            retval['error'] = error_message(e)
+        finally:
+            if reservation is not None:
+                release_reservation(reservation)
+        retval['duration'] = time.time() - started
+    return retval
+
+
+@route(PREFIX + '/containers/actions/:action', method='POST')
+def post_bulk_action(action):
+    if action not in ACTION_HANDLERS:
+        abort(404, 'Unknown action %s' % action)
+    data = request.json
+    if not data:
         abort(400, 'No data received')
+    names = data.get('names', [])
+    if not isinstance(names, list) or not all(isinstance(name, str) for name in names):
+        abort(400, 'names must be a list of container names')
+    if not isinstance(data.get('pattern', ''), str):
+        abort(400, 'pattern must be a string')
 
-    container = get_container_object(name)
-    if not container.running:
-        return False
+    existing = list_containers()
+    names = list(names)
+    if 'pattern' in data:
+        #golden pool bases must stay stopped, only given by name
+        names += [name for name in existing
+                  if fnmatch.fnmatchcase(name, data['pattern']) and name not in names
+                  and not name.startswith(GOLDEN_PREFIX)]
+    unknown = [name for name in names if name not in existing]
+    names = [name for name in names if name in existing]
+    return job_accepted(submit_job('bulk_' + action, None, run_bulk_action, action, names, unknown))
 
-    namespace = data['namespaces']
-    cmd = data['cmd']
 
-    attach = ["lxc-attach", "-n", name,
-              "-P", container.get_config_path()]
-    if namespace != "ALL":
-        attach += ["-s", namespace]
+def run_bulk_action(action, names, unknown):
+    """ Job: action on BULK_WORKERS containers at a time, returns the
+    status of each one
+    """
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=BULK_WORKERS) as executor:
+        results = list(executor.map(lambda name: bulk_action(action, name), names))
+    results += [{'name': name, 'status': 'failed', 'error': 'Unknown container'}
+                for name in unknown]
+    return {'action': action,
+            'results': results,
+            'duration': time.time() - started}
 
-    if cmd:
-        attach += ["--"] + list(cmd)
+DOC_API["apis"].append(DOC_API_CONTAINERS_BULK_ACTIONS)
 
-    if subprocess.call(
-            attach,
-            universal_newlines=True) != 0:
-        return False
+""" 
+    Jobs
+"""
+DOC_API_JOBS_COLLECTION = {
+            "description": "Jobs collection",
+            "operations": [],
+            "path": "/jobs",
+            "summary":"Long running container actions",
+            "notes": "",
+            "errorResponses":[]}
+
+DOC_MODEL_JOB = {
+            "id": "job",
+            "properties":{
+                "id":{
+                    "type": "string",
+                    "required": True,
+                    "description": "Id of the job"},
+                "action":{
+                    "type": "string",
+                    "required": True,
+                    "description": "create, start, stop, shutdown, restart, freeze or unfreeze, bulk_{action} for bulk actions"},
+                "container":{
+                    "type": "string",
+                    "required": True,
+                    "description": "Name of the container, null for bulk actions"},
+                "status":{
+                    "type": "string",
+                    "required": True,
+                    "description": "queued, running, done or failed"},
+                "created":{
+                    "type": "float",
+                    "required": True,
+                    "description": "timestamp of the submission"},
+                "started":{
+                    "type": "float",
+                    "required": False,
+                    "description": "timestamp of the start of the lxc calls"},
+                "finished":{
+                    "type": "float",
+                    "required": False,
+                    "description": "timestamp of the end of the lxc calls"},
+                "duration":{
+                    "type": "float",
+                    "required": False,
+                    "description": "seconds spent in the lxc calls"},
+                "result":{
+                    "type": "container",
+                    "required": False,
+                    "description": "container details for a finished create, {action, results, duration} for bulk actions"},
+                "error":{
+                    "type": "string",
+                    "required": False,
+                    "description": "error message of a failed job"}
+            }
+}
+DOC_API['models']["job"] = DOC_MODEL_JOB
+
+"""GET on jobs collection"""
+DOC_API_JOBS_COLLECTION['operations'].append({
+            "httpMethod":"GET",
+            "nickname":"getJobs",
+            "responseClass":"void",
+            "parameters":[{
+                "name":"container",
+                "allowMultiple": False,
+                "dataType": "string",
+                "description": "only jobs of this container",
+                "paramType": "query",
+                "required": False
+                }],
+            "summary":"Get the list of known jobs, oldest first",
+            "notes": "",
+            "errorResponses":[]
+                      })
+
+@route(PREFIX + '/jobs', method='GET')
+def get_job_list():
+    name = request.query.get('container')
+    with JOBS_LOCK:
+        jobs = [dict(job) for job in JOBS.values()
+                if name is None or job['container'] == name]
+    return {'jobs': jobs}
+
+DOC_API["apis"].append(DOC_API_JOBS_COLLECTION)
+
+DOC_API_JOBS_ITEM = {
+            "description": "Job item",
+            "operations": [],
+            "path": "/jobs/{id}",
+            "summary":"Job status",
+            "notes": "",
+            "errorResponses":[]}
+
+"""GET on job"""
+DOC_API_JOBS_ITEM['operations'].append({
+            "httpMethod":"GET",
+            "nickname":"getJob",
+            "responseClass":"job",
+            "parameters":[{
+                "name":"id",
+                "allowMultiple": False,
+                "dataType": "string",
+                "description": "job id",
+                "paramType": "path",
+                "required": True
+                }],
+            "summary":"Get status, timing and result of a job",
+            "notes": "",
+            "errorResponses":[{"code": 404, "reason": "Unknown job"}]
+                      })
+
+@route(PREFIX + '/jobs/:job_id', method='GET')
+def get_job(job_id):
+    with JOBS_LOCK:
+        job = JOBS.get(job_id)
+        #pruned at any time by the workers: copied while the lock is held
+        job = dict(job) if job is not None else None
+    if job is None:
+        abort(404, 'Unknown job %s' % job_id)
+    return job
+
+DOC_API["apis"].append(DOC_API_JOBS_ITEM)
+
+""" 
+    Action limits
+"""
+DOC_API_LIMITS = {
+            "description": "Action limits",
+            "operations": [],
+            "path": "/limits",
+            "summary":"Concurrency and rate limits of the actions",
+            "notes": "",
+            "errorResponses":[]}
+
+DOC_API_LIMITS['operations'].append({
+            "httpMethod":"GET",
+            "nickname":"getLimits",
+            "responseClass":"void",
+            "parameters":[],
+            "summary":"Get the limits of each action with its running and waiting jobs",
+            "notes": "requests over a limit get 429 with Retry-After; duration is the moving average running time",
+            "errorResponses":[]
+                      })
+
+@route(PREFIX + '/limits', method='GET')
+def get_limits():
+    actions = sorted(set(ACTION_LIMITS) | set(LIMITS))
+    return {'limits': [action_limit(action).view() for action in actions],
+            'queue_size': ACTION_QUEUE_SIZE}
+
+DOC_API["apis"].append(DOC_API_LIMITS)
+
+""" 
+    Templates and their cache (golden pool)
+"""
+def template_key(template_name, template_args):
+    """ Normalized template name and args: same key for identical builds """
+    args = sorted((str(key).strip(), str(val).strip())
+                  for key, val in template_args.items()
+                  if not isinstance(val, list))
+    args += sorted((str(key).strip(), [str(item).strip() for item in val])
+                   for key, val in template_args.items()
+                   if isinstance(val, list))
+    return json.dumps([template_name.strip(), args])
+
+
+def golden_name(template_name, template_args):
+    """ Name of the base container of a template and its args """
+    key = template_key(template_name, template_args)
+    return "%s%s-%s" % (GOLDEN_PREFIX, template_name.strip(),
+                        hashlib.sha1(key.encode('utf-8')).hexdigest()[:10])
+
+
+def rootfs_size(container):
+    """ Bytes used on disk by a container rootfs directory """
+    rootfs = container.get_config_item('lxc.rootfs')
+    #overlayfs:/lower:/upper, the container owns the last path
+    rootfs = rootfs.split(':')[-1]
+    size = 0
+    for root, dirs, files in os.walk(rootfs):
+        for filename in files:
+            try:
+                size += os.lstat(os.path.join(root, filename)).st_blocks * 512
+            except OSError:
+                pass
+    return size
+
+
+def create_golden(template_name, template_args):
+    """ Base container of the template, created by the first caller
+
+    Marks the entry as used and evicts the least recently used ones
+    above TEMPLATE_CACHE_SIZE
+    """
+    template_name = template_name.strip()
+    name = golden_name(template_name, template_args)
+    with container_lock(name):
+        created = None
+        if name not in list_containers():
+            if not get_container_object(name).create(template_name, template_args):
+                abort(500, 'container.create failed for golden %s' % name)
+            created = time.time()
+            index_update(name, template=template_name, created=created)
+            invalidate_snapshot()
+            with GOLDEN_LOCK:
+                GOLDEN.pop(name, None)
+        if name not in GOLDEN:
+            entry = golden_entry(name)
+            with GOLDEN_LOCK:
+                GOLDEN.setdefault(name, entry)
+        with GOLDEN_LOCK:
+            entry = GOLDEN[name]
+            entry['key'] = template_key(template_name, template_args)
+            entry['template'] = {'name': template_name, 'args': template_args}
+            entry['created'] = entry['created'] or created
+            entry['last_used'] = time.time()
+            entry['hits'] += 1
+    evict_golden(keep=name)
+    return name
+
+
+def golden_entry(name, measure=True):
+    """ Cache entry of a base container, its template is unknown if it was
+    created by a previous run
+
+    Without measure its size is None, to be set by measure_golden()
+    """
+    return {'name': name,
+            'key': None,
+            'template': None,
+            'size': rootfs_size(get_container_object(name)) if measure else None,
+            'created': None,
+            'last_used': 0,
+            'hits': 0}
+
+
+def measure_golden(name):
+    """ Job: size of a base container found by golden_list() """
+    size = rootfs_size(get_container_object(name))
+    with GOLDEN_LOCK:
+        if name in GOLDEN:
+            GOLDEN[name]['size'] = size
+    return {'name': name, 'size': size}
+
+
+def golden_list():
+    """ Entries of the cache, also the bases of previous runs """
+    names = [name for name in list_containers() if name.startswith(GOLDEN_PREFIX)]
+    with GOLDEN_LOCK:
+        for name in list(GOLDEN):
+            if name not in names:
+                del GOLDEN[name]
+        unknown = [name for name in names if name not in GOLDEN]
+    for name in unknown:
+        #walking its rootfs is left to a job, off the request path
+        entry = golden_entry(name, measure=False)
+        with GOLDEN_LOCK:
+            added = GOLDEN.setdefault(name, entry) is entry
+        if added:
+            submit_job('golden_size', name, measure_golden, name)
+    with GOLDEN_LOCK:
+        return sorted((dict(entry) for entry in GOLDEN.values()),
+                      key=lambda entry: entry['last_used'], reverse=True)
+
+
+def destroy_golden(name):
+    """ Destroy a base container, False if lxc refuses (clones use it) """
+    with container_lock(name):
+        if not get_container_object(name).destroy():
+            return False
+        index_delete(name)
+    with GOLDEN_LOCK:
+        GOLDEN.pop(name, None)
+    invalidate_snapshot()
     return True
-#@route(PREFIX + '/containers/:name/actions/clone', method='POST')
-#def clone_container(name):
-#    load_container(name)
-#    CONTAINERS[name].unfreeze
 
-DOC_API["apis"].append(DOC_API_CONTAINER_ACTIONS)
+
+def evict_golden(keep=None):
+    """ Destroy least recently used bases until the cache fits its size """
+    evicted = []
+    entries = golden_list()
+    #bases not measured yet count for nothing until their job ends
+    total = sum(entry['size'] or 0 for entry in entries)
+    for entry in reversed(entries):
+        if total <= TEMPLATE_CACHE_SIZE:
+            break
+        if entry['name'] != keep and destroy_golden(entry['name']):
+            total -= entry['size'] or 0
+            evicted.append(entry['name'])
+    return evicted
+
+
+def available_templates():
+    """ Names of the lxc templates installed on the host """
+    retval = []
+    if os.path.isdir(LXC_TEMPLATES_DIR):
+        for filename in sorted(os.listdir(LXC_TEMPLATES_DIR)):
+            if filename.startswith('lxc-'):
+                retval.append(filename[len('lxc-'):])
+    return retval
+
+
+DOC_API_TEMPLATES = {
+            "description": "Templates",
+            "operations": [],
+            "path": "/templates",
+            "summary":"Available templates",
+            "notes": "",
+            "errorResponses":[]}
+
+DOC_API_TEMPLATES['operations'].append({
+            "httpMethod":"GET",
+            "nickname":"getTemplates",
+            "responseClass":"void",
+            "parameters":[],
+            "summary":"Get the templates installed on the host and their cached builds",
+            "notes": "cached lists the template args of the builds in the cache",
+            "errorResponses":[]
+                      })
+
+@route(PREFIX + '/templates', method='GET')
+def get_template_list():
+    cached = {}
+    for entry in golden_list():
+        if entry['template'] is not None:
+            cached.setdefault(entry['template']['name'], []).append(
+                                        entry['template']['args'])
+    names = available_templates()
+    names += sorted(name for name in cached if name not in names)
+    return {'templates': [{'name': name, 'cached': cached.get(name, [])}
+                          for name in names]}
+
+DOC_API["apis"].append(DOC_API_TEMPLATES)
+
+DOC_API_TEMPLATES_CACHE = {
+            "description": "Templates cache",
+            "operations": [],
+            "path": "/templates/cache",
+            "summary":"Base containers cloned by creations (golden pool)",
+            "notes": "",
+            "errorResponses":[]}
+
+DOC_API_TEMPLATES_CACHE['operations'].append({
+            "httpMethod":"GET",
+            "nickname":"getTemplatesCache",
+            "responseClass":"void",
+            "parameters":[],
+            "summary":"Get the cached builds, most recently used first",
+            "notes": "template is null for bases created by a previous run, size is null until a golden_size job measured them",
+            "errorResponses":[]
+                      })
+
+DOC_API_TEMPLATES_CACHE['operations'].append({
+            "httpMethod":"POST",
+            "nickname":"warmTemplatesCache",
+            "responseClass":"job",
+            "parameters":[{
+                "allowMultiple": False,
+                "dataType": "template",
+                "description": "template to build",
+                "paramType": "body",
+                "required": True
+                }],
+            "summary":"Build a template in the cache ahead of creations",
+            "notes": "queued: 202 and a job, see /jobs/{id}",
+            "errorResponses":[]
+                      })
+
+DOC_API_TEMPLATES_CACHE['operations'].append({
+            "httpMethod":"DELETE",
+            "nickname":"purgeTemplatesCache",
+            "responseClass":"void",
+            "parameters":[{
+                "name":"name",
+                "allowMultiple": False,
+                "dataType": "string",
+                "description": "base container to purge (default: all)",
+                "paramType": "query",
+                "required": False
+                }],
+            "summary":"Purge cached builds",
+            "notes": "bases still used by snapshot clones are kept",
+            "errorResponses":[]
+                      })
+
+@route(PREFIX + '/templates/cache', method='GET')
+def get_template_cache():
+    entries = golden_list()
+    return {'enabled': GOLDEN_POOL,
+            'size': sum(entry['size'] or 0 for entry in entries),
+            'max_size': TEMPLATE_CACHE_SIZE,
+            'entries': entries}
+
+
+@route(PREFIX + '/templates/cache', method='POST')
+def warm_template_cache():
+    data = request.json
+    if not data or 'name' not in data:
+        abort(400, 'No template received')
+    template_args = keyval_list_to_dict(data.get('args', []))
+    name = golden_name(data['name'], template_args)
+    return job_accepted(submit_job('golden', name, create_golden,
+                                   data['name'], template_args))
+
+
+@route(PREFIX + '/templates/cache', method='DELETE')
+def purge_template_cache():
+    names = [entry['name'] for entry in golden_list()]
+    if request.query.get('name'):
+        if request.query.get('name') not in names:
+            abort(404, 'Unknown cached build %s' % request.query.get('name'))
+        names = [request.query.get('name')]
+    purged = [name for name in names if destroy_golden(name)]
+    return {'purged': purged,
+            'kept': [name for name in names if name not in purged]}
+
+DOC_API["apis"].append(DOC_API_TEMPLATES_CACHE)
+
+""" 
+    Events
+"""
+DOC_API_EVENTS = {
+            "description": "Container events",
+            "operations": [],
+            "path": "/events",
+            "summary":"Container state changes",
+            "notes": "",
+            "errorResponses":[]}
+
+DOC_MODEL_EVENT = {
+            "id": "event",
+            "properties":{
+                "id":{
+                    "type": "int",
+                    "required": True,
+                    "description": "Increasing id of the event, use it as since"},
+                "type":{
+                    "type": "string",
+                    "required": True,
+                    "description": "created, destroyed, state or ips"},
+                "container":{
+                    "type": "string",
+                    "required": True,
+                    "description": "Name of the container"},
+                "time":{
+                    "type": "float",
+                    "required": True,
+                    "description": "timestamp of the detection"},
+                "state":{
+                    "type": "string",
+                    "required": False,
+                    "description": "new state for created and state events"},
+                "previous":{
+                    "type": "string",
+                    "required": False,
+                    "description": "old state for state events"},
+                "ips":{
+                    "type": "List",
+                    "items": {"type": "string"},
+                    "required": False,
+                    "description": "ip addresses for ips events"}
+            }
+}
+DOC_API['models']["event"] = DOC_MODEL_EVENT
+
+"""GET on events"""
+DOC_API_EVENTS['operations'].append({
+            "httpMethod":"GET",
+            "nickname":"getEvents",
+            "responseClass":"void",
+            "parameters":[{
+                "name":"since",
+                "allowMultiple": False,
+                "dataType": "int",
+                "description": "id of the last event seen, 0 for the whole history (default: last event id)",
+                "paramType": "query",
+                "required": False
+                },{
+                "name":"container",
+                "allowMultiple": False,
+                "dataType": "string",
+                "description": "only events of this container",
+                "paramType": "query",
+                "required": False
+                },{
+                "name":"timeout",
+                "allowMultiple": False,
+                "dataType": "float",
+                "description": "seconds to wait for an event (default and max: %s, %s with --server wsgiref)" % (
+                                        EVENT_TIMEOUT, WAIT_SINGLE_THREADED_TIMEOUT),
+                "paramType": "query",
+                "required": False
+                }],
+            "summary":"Long-poll the events after since",
+            "notes": "with Accept: text/event-stream, the events are streamed as Server-Sent Events (Last-Event-ID is honored), only with --server threaded",
+            "errorResponses":[{"code": 400, "reason": "since or timeout not a number"},
+                              {"code": 406, "reason": "Server-Sent Events asked to the single threaded server"}]
+                      })
+
+def stream_events(since, name):
+    """ Server-Sent Events generator, a comment line keeps it alive """
+    while True:
+        events, since = get_events(since, name, EVENT_TIMEOUT)
+        if not events:
+            yield ": keepalive\n\n"
+        for event in events:
+            yield "id: %s\nevent: %s\ndata: %s\n\n" % (
+                        event['id'], event['type'], json.dumps(event))
+
+
+@route(PREFIX + '/events', method='GET')
+def get_event_list():
+    since = request.query.get('since') or request.get_header('Last-Event-ID')
+    since = EVENT_ID if since is None else number_param(since, int, 'since')
+    name = request.query.get('container')
+    if 'text/event-stream' in request.get_header('Accept', ''):
+        if SINGLE_THREADED:
+            #the stream would hold the only thread forever
+            abort(406, 'Server-Sent Events need --server threaded, long-poll without them')
+        response.content_type = 'text/event-stream'
+        response.set_header('Cache-Control', 'no-cache')
+        return stream_events(since, name)
+    timeout = min(number_param(request.query.get('timeout', EVENT_TIMEOUT), float, 'timeout'),
+                  WAIT_SINGLE_THREADED_TIMEOUT if SINGLE_THREADED else EVENT_TIMEOUT)
+    events, last_id = get_events(since, name, timeout)
+    return {'events': events, 'last_id': last_id}
+
+DOC_API["apis"].append(DOC_API_EVENTS)
+
+""" 
+    Metrics
+"""
+DOC_API_METRICS = {
+            "description": "Metrics",
+            "operations": [],
+            "path": "/metrics",
+            "summary":"Requests, jobs and liblxc calls metrics",
+            "notes": "",
+            "errorResponses":[]}
+
+DOC_API_METRICS['operations'].append({
+            "httpMethod":"GET",
+            "nickname":"getMetrics",
+            "responseClass":"void",
+            "parameters":[],
+            "summary":"Get the counters and latency histograms in prometheus text format",
+            "notes": "requests by route, jobs by action and liblxc calls (create, start, wait, get_ips, get_config_item...) are timed separately",
+            "errorResponses":[]
+                      })
+
+@route(PREFIX + '/metrics', method='GET')
+def get_metrics():
+    response.content_type = 'text/plain; version=0.0.4'
+    return metrics_text()
+
+DOC_API["apis"].append(DOC_API_METRICS)
+
+install(MetricsPlugin())
+default_app().uninstall('json')
+install(EncoderPlugin())
+
+#every api is documented by now: serialized once
+DOC_API_BODY = json.dumps(DOC_API)
+DOC_API_ETAG = json_etag(DOC_API)
 
 @route(PREFIX + "/api-docs.json/containers", method='GET')
 def doc_containers():
-    return DOC_API
+    return cached_json(DOC_API_BODY, DOC_API_ETAG)
+
+
+def preload_static(roots=('swagger', '.')):
+    """ Read the swagger ui files into memory, swagger.html for '.' """
+    for root in roots:
+        for dirpath, dirnames, filenames in os.walk(root):
+            if root == '.':
+                filenames, dirnames[:] = [name for name in filenames if name == 'swagger.html'], []
+            for filename in filenames:
+                path = os.path.abspath(os.path.join(dirpath, filename))
+                with open(path, 'rb') as asset:
+                    body = asset.read()
+                STATIC_ASSETS[path] = {
+                    'body': body,
+                    'etag': '"%s"' % hashlib.sha1(body).hexdigest(),
+                    'last_modified': formatdate(os.stat(path).st_mtime, usegmt=True),
+                    'content_type': mimetypes.guess_type(path)[0] or 'application/octet-stream'}
+
+
+def static_asset(filename, root, max_age=None):
+    """ A swagger ui file cacheable max_age seconds (default: STATIC_MAX_AGE,
+    0: revalidated each time)
+
+    Served from memory with an ETag if preloaded, else by static_file
+    which answers If-Modified-Since
+    """
+    max_age = STATIC_MAX_AGE if max_age is None else max_age
+    cache_control = 'public, max-age=%d' % max_age if max_age else 'no-cache'
+    asset = STATIC_ASSETS.get(os.path.abspath(os.path.join(root, filename)))
+    if asset is None:
+        retval = static_file(filename, root=root)
+        if retval.status_code < 400:
+            retval.set_header('Cache-Control', cache_control)
+        return retval
+    response.set_header('Cache-Control', cache_control)
+    response.set_header('Last-Modified', asset['last_modified'])
+    if not_modified(asset['etag']):
+        return ''
+    response.content_type = asset['content_type']
+    return asset['body']
+
 
 @route('/lib/<filename:re:.*\.js>', method='GET')
 def javascripts(filename):
-    return static_file(filename, root='swagger/lib')
+    return static_asset(filename, root='swagger/lib')
 
 
 @route('/css/<filename:re:.*\.css>', method='GET')
 def stylesheets(filename):
-    return static_file(filename, root='swagger/css')
+    return static_asset(filename, root='swagger/css')
 
 
 @route('/images/<filename:re:.*\.(jpg|png|gif|ico)>', method='GET')
 def images(filename):
-    return static_file(filename, root='swagger/images')
+    return static_asset(filename, root='swagger/images')
 
 
 @route('/swagger-ui.js', method='GET')
 def swagger_ui():
-    return static_file('swagger-ui.min.js', root='swagger')
+    return static_asset('swagger-ui.min.js', root='swagger')
 
 
 @route('/info', method='GET')
 def index():
-    return static_file('swagger.html', root='.')
+    return static_asset('swagger.html', root='.', max_age=0)
+
+class PooledWSGIServer(ThreadingMixIn, WSGIServer):
+    """ wsgiref server handing the connections to a bounded thread pool """
+    daemon_threads = True
+    request_queue_size = 128
+    pool = None
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+
+class ThreadedServer(ServerAdapter):
+    """ Bottle adapter for PooledWSGIServer, option: workers """
+
+    def run(self, app):
+        quiet = self.quiet
+
+        class Handler(WSGIRequestHandler):
+            def log_request(self, *args, **kwargs):
+                if not quiet:
+                    return WSGIRequestHandler.log_request(self, *args, **kwargs)
+
+        server_cls = type('PooledWSGIServer', (PooledWSGIServer, ), {
+            'pool': ThreadPoolExecutor(max_workers=self.options.get('workers', SERVER_WORKERS))})
+        self.server = make_server(self.host, self.port, app, server_cls, Handler)
+        self.server.serve_forever()
+
+
+def server_options(server, workers):
+    """ bottle run() arguments for a --server choice """
+    if server == 'wsgiref':
+        return {'server': 'wsgiref', 'debug': True}
+    if server == 'threaded':
+        return {'server': ThreadedServer, 'workers': workers}
+    if server == 'paste':
+        return {'server': 'paste', 'use_threadpool': True, 'threadpool_workers': workers}
+    if server == 'cherrypy':
+        return {'server': 'cherrypy', 'numthreads': workers}
+    if server == 'waitress':
+        return {'server': 'waitress', 'threads': workers}
+    raise ValueError('Unknown server %s' % server)
+
+
+def parse_action_limit(text):
+    """ (action, (concurrency, rate, burst)) of ACTION=CONCURRENCY[,RATE[,BURST]] """
+    action, sep, values = text.partition('=')
+    values = values.split(',')
+    if not sep or not action or len(values) > 3:
+        raise argparse.ArgumentTypeError('%s is not ACTION=CONCURRENCY[,RATE[,BURST]]' % text)
+    try:
+        concurrency, rate, burst = [float(value) if value else None for value in (values + ['', ''])[:3]]
+    except ValueError:
+        raise argparse.ArgumentTypeError('%s: CONCURRENCY, RATE and BURST must be numbers' % text)
+    return action, (int(concurrency) if concurrency else None, rate, burst)
+
 
 def main():
+    global JOB_WORKERS, SNAPSHOT_TTL, BULK_WORKERS, GOLDEN_POOL, GOLDEN_BDEVTYPE
+    global TEMPLATE_CACHE_SIZE, EXEC_MAX, EXEC_SLOTS, SESSION_IDLE_TIMEOUT, SESSIONS_PER_CONTAINER
+    global ADMISSION, ADMISSION_MEMORY, ADMISSION_CPUS, ADMISSION_DISK_RESERVE, ADMISSION_QUEUE_SIZE
+    global ADMISSION_DEFAULT_CPUS
+    global ACTION_QUEUE_SIZE, DHCP_LEASES, JSON_DUMPS, STATIC_MAX_AGE, SINGLE_THREADED
     if not is_good_lxc_version(LXC_MIN_VERSION):
         raise Exception('Please Use LXC > %s' % LXC_MIN_VERSION)
     parser = argparse.ArgumentParser(description='Lxc Restful Webservice.')
@@ -611,9 +4164,133 @@ def main():
                         nargs='?',
                         help='tcp port to listen on (default: 8080)',
                         default="8080")
+    parser.add_argument('--server',
+                        choices=SERVERS,
+                        help='http server, wsgiref serves one request at a time (default: wsgiref)',
+                        default='wsgiref')
+    parser.add_argument('--workers',
+                        type=int,
+                        help='threads serving requests with multi-threaded servers (default: %s)' % SERVER_WORKERS,
+                        default=SERVER_WORKERS)
+    parser.add_argument('--snapshot-ttl',
+                        type=float,
+                        help='seconds the containers listing is served from cache (default: %s)' % SNAPSHOT_TTL,
+                        default=SNAPSHOT_TTL)
+    parser.add_argument('--bulk-workers',
+                        type=int,
+                        help='containers handled in parallel by a bulk action (default: %s)' % BULK_WORKERS,
+                        default=BULK_WORKERS)
+    parser.add_argument('--golden-pool',
+                        action='store_true',
+                        help='create containers by cloning a base container per template and args')
+    parser.add_argument('--golden-bdevtype',
+                        help='backing store of the golden pool clones (default: %s)' % GOLDEN_BDEVTYPE,
+                        default=GOLDEN_BDEVTYPE)
+    parser.add_argument('--template-cache-size',
+                        type=int,
+                        help='MB of disk used by the golden pool (default: %s)' % (TEMPLATE_CACHE_SIZE // 1024 ** 2),
+                        default=TEMPLATE_CACHE_SIZE // 1024 ** 2)
+    parser.add_argument('--exec-max',
+                        type=int,
+                        help='exec sessions streaming at the same time (default: %s)' % EXEC_MAX,
+                        default=EXEC_MAX)
+    parser.add_argument('--sessions-per-container',
+                        type=int,
+                        help='exec sessions open at the same time on a container (default: %s)' % SESSIONS_PER_CONTAINER,
+                        default=SESSIONS_PER_CONTAINER)
+    parser.add_argument('--session-idle-timeout',
+                        type=float,
+                        help='seconds before an idle exec session is closed (default: %s)' % SESSION_IDLE_TIMEOUT,
+                        default=SESSION_IDLE_TIMEOUT)
+    parser.add_argument('--index',
+                        metavar='PATH',
+                        help='sqlite file indexing the containers: the listing is served from it at start, then reconciled with lxc')
+    parser.add_argument('--leases',
+                        nargs='*',
+                        metavar='PATH',
+                        help='dnsmasq lease files giving the containers ips (default: %s)' % " ".join(DHCP_LEASES),
+                        default=DHCP_LEASES)
+    parser.add_argument('--json-encoder',
+                        choices=[name for name in JSON_ENCODERS if json_encoder(name) is not None],
+                        help='json encoder of the responses (default: the first installed of %s)' % ", ".join(JSON_ENCODERS))
+    parser.add_argument('--preload-static',
+                        action='store_true',
+                        help='read the swagger ui files into memory at start')
+    parser.add_argument('--static-max-age',
+                        type=int,
+                        help='seconds browsers may cache the swagger ui files (default: %s)' % STATIC_MAX_AGE,
+                        default=STATIC_MAX_AGE)
+    parser.add_argument('--job-workers',
+                        type=int,
+                        help='workers shared by the jobs of the actions without a concurrency limit; '
+                             'an action limited by --action-limit runs its jobs in a pool of its own (default: %s)' % JOB_WORKERS,
+                        default=JOB_WORKERS)
+    parser.add_argument('--action-limit',
+                        action='append',
+                        type=parse_action_limit,
+                        metavar='ACTION=CONCURRENCY[,RATE[,BURST]]',
+                        help='limits of an action, e.g. create=4,0.5 for 4 running and 0.5 per second, its jobs run in a pool '
+                             'of CONCURRENCY workers on top of --job-workers; repeatable (default: %s)'
+                             % ' '.join('%s=%s' % (action, ACTION_LIMITS[action][0]) for action in sorted(ACTION_LIMITS)),
+                        default=[])
+    parser.add_argument('--action-queue',
+                        type=int,
+                        help='jobs of a limited action waiting to run before 429 (default: %s)' % ACTION_QUEUE_SIZE,
+                        default=ACTION_QUEUE_SIZE)
+    parser.add_argument('--admission',
+                        action='store_true',
+                        help='queue starts, restarts, unfreezes and creates which would oversubscribe the host budgets')
+    parser.add_argument('--memory-budget',
+                        type=int,
+                        help='MB of memory the running containers may commit (default: host memory)')
+    parser.add_argument('--cpu-budget',
+                        type=float,
+                        help='cpus the running containers may commit (default: host cpus)')
+    parser.add_argument('--unlimited-cpus',
+                        type=float,
+                        help='cpus committed by a container without cpu limit (default: %s)' % ADMISSION_DEFAULT_CPUS,
+                        default=ADMISSION_DEFAULT_CPUS)
+    parser.add_argument('--disk-reserve',
+                        type=int,
+                        help='MB of disk kept free by creates (default: %s)' % (ADMISSION_DISK_RESERVE // 1024 ** 2),
+                        default=ADMISSION_DISK_RESERVE // 1024 ** 2)
+    parser.add_argument('--admission-queue',
+                        type=int,
+                        help='starts and creates waiting for room before answering 503 (default: %s)' % ADMISSION_QUEUE_SIZE,
+                        default=ADMISSION_QUEUE_SIZE)
     
     args = parser.parse_args()
-    run(host=args.ip, port=args.port, debug=True)
+    JOB_WORKERS = args.job_workers
+    BULK_WORKERS = args.bulk_workers
+    GOLDEN_POOL = args.golden_pool
+    GOLDEN_BDEVTYPE = args.golden_bdevtype
+    TEMPLATE_CACHE_SIZE = args.template_cache_size * 1024 ** 2
+    EXEC_MAX = args.exec_max
+    EXEC_SLOTS = threading.BoundedSemaphore(EXEC_MAX)
+    SNAPSHOT_TTL = args.snapshot_ttl
+    SESSION_IDLE_TIMEOUT = args.session_idle_timeout
+    SESSIONS_PER_CONTAINER = args.sessions_per_container
+    DHCP_LEASES = args.leases
+    if args.json_encoder:
+        JSON_DUMPS = json_encoder(args.json_encoder)
+    STATIC_MAX_AGE = args.static_max_age
+    if args.preload_static:
+        preload_static()
+    ACTION_LIMITS.update(args.action_limit)
+    ACTION_QUEUE_SIZE = args.action_queue
+    ADMISSION = args.admission
+    if args.memory_budget is not None:
+        ADMISSION_MEMORY = args.memory_budget * 1024 ** 2
+    ADMISSION_CPUS = args.cpu_budget
+    ADMISSION_DEFAULT_CPUS = args.unlimited_cpus
+    ADMISSION_DISK_RESERVE = args.disk_reserve * 1024 ** 2
+    ADMISSION_QUEUE_SIZE = args.admission_queue
+    if args.index:
+        open_index(args.index)
+    start_snapshot_refresher()
+    start_session_reaper()
+    SINGLE_THREADED = args.server == 'wsgiref'
+    run(host=args.ip, port=args.port, **server_options(args.server, args.workers))
 
                     
 if  __name__ == "__main__":
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark of every route of lxc_restapi against the fake lxc (tests/stub)
+
+No lxc, no root: the stub simulates --containers containers and the
+latency of each liblxc call (--latency, --latencies create=2,start=0.5).
+Each scenario sends --requests requests from --concurrency clients to a
+threaded server and reports throughput and p50/p99 latency.
+"""
+
+import argparse
+import fnmatch
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT, "tests", "stub"), ROOT]
+
+import bottle
+import lxc
+import lxc_restapi
+
+#routes not benchmarked: they run commands on the host
+SKIPPED_ROUTES = ['/v1/containers/:name/actions/chrootcmd',
+                  '/v1/containers/:name/actions/attach']
+
+
+def scenarios(names):
+    """ (name, method, route, path and body factory) of each scenario
+
+    The factory gets the request number and returns (path, body)
+    """
+    def name(i):
+        return names[i % len(names)]
+
+    return [
+        ("list", "GET", "/v1/containers",
+            lambda i: ("/v1/containers", None)),
+        ("list fresh", "GET", "/v1/containers",
+            lambda i: ("/v1/containers?fresh=1", None)),
+        ("list running", "GET", "/v1/containers",
+            lambda i: ("/v1/containers?state=RUNNING", None)),
+        ("list page", "GET", "/v1/containers",
+            lambda i: ("/v1/containers?sort=-state&limit=20", None)),
+        ("list prefix fresh", "GET", "/v1/containers",
+            lambda i: ("/v1/containers?name_prefix=%s&fresh=1" % name(i)[:-1], None)),
+        ("list detail", "GET", "/v1/containers",
+            lambda i: ("/v1/containers?detail=ips,conf_hash,actions", None)),
+        ("details", "GET", "/v1/containers/:name",
+            lambda i: ("/v1/containers/%s" % name(i), None)),
+        ("details state,ips", "GET", "/v1/containers/:name",
+            lambda i: ("/v1/containers/%s?fields=state,ips" % name(i), None)),
+        ("ips", "GET", "/v1/containers/:name/ips",
+            lambda i: ("/v1/containers/%s/ips" % name(i), None)),
+        ("modify", "PUT", "/v1/containers/:name",
+            lambda i: ("/v1/containers/%s" % name(i),
+                       {"conf": [{"key": "lxc.tty", "val": str(i % 8)}]})),
+        ("modify unchanged", "PUT", "/v1/containers/:name",
+            lambda i: ("/v1/containers/%s" % name(i),
+                       {"conf": [{"key": "lxc.tty", "val": "4"}]})),
+        ("conf", "GET", "/v1/containers/:name/conf",
+            lambda i: ("/v1/containers/%s/conf" % name(i), None)),
+        ("cgroups", "GET", "/v1/containers/:name/cgroups",
+            lambda i: ("/v1/containers/%s/cgroups" % name(i), None)),
+        ("set cgroups", "PUT", "/v1/containers/:name/cgroups",
+            lambda i: ("/v1/containers/%s/cgroups" % name(i),
+                       {"cgroups": [{"key": "cpu.shares", "val": str(512 + i % 8)}]})),
+        ("stats", "GET", "/v1/containers/:name/stats",
+            lambda i: ("/v1/containers/%s/stats" % name(i), None)),
+        ("bulk stats", "GET", "/v1/stats",
+            lambda i: ("/v1/stats", None)),
+        ("limits", "GET", "/v1/limits",
+            lambda i: ("/v1/limits", None)),
+        ("capacity", "GET", "/v1/host/capacity",
+            lambda i: ("/v1/host/capacity", None)),
+        ("wait", "GET", "/v1/containers/:name/wait",
+            lambda i: ("/v1/containers/%s/wait?timeout=0" % name(i), None)),
+        ("create", "POST", "/v1/containers",
+            lambda i: ("/v1/containers",
+                       {"name": "bench-%06d" % i,
+                        "template": {"name": "ubuntu", "args": []}})),
+        ("start", "POST", "/v1/containers/:name/actions/start",
+            lambda i: ("/v1/containers/%s/actions/start" % name(i), {})),
+        ("freeze", "POST", "/v1/containers/:name/actions/freeze",
+            lambda i: ("/v1/containers/%s/actions/freeze" % name(i), {})),
+        ("unfreeze", "POST", "/v1/containers/:name/actions/unfreeze",
+            lambda i: ("/v1/containers/%s/actions/unfreeze" % name(i), {})),
+        ("restart", "POST", "/v1/containers/:name/actions/restart",
+            lambda i: ("/v1/containers/%s/actions/restart" % name(i), {})),
+        ("shutdown", "POST", "/v1/containers/:name/actions/shutdown",
+            lambda i: ("/v1/containers/%s/actions/shutdown" % name(i), {})),
+        ("stop", "POST", "/v1/containers/:name/actions/stop",
+            lambda i: ("/v1/containers/%s/actions/stop" % name(i), {})),
+        ("clone", "POST", "/v1/containers/:name/actions/clone",
+            lambda i: ("/v1/containers/%s/actions/clone" % name(i),
+                       {"name": "clone-%06d" % i, "snapshot": True})),
+        ("bulk start", "POST", "/v1/containers/actions/:action",
+            lambda i: ("/v1/containers/actions/start", {"pattern": "stub-00*"})),
+        ("bulk stop", "POST", "/v1/containers/actions/:action",
+            lambda i: ("/v1/containers/actions/stop", {"pattern": "stub-00*"})),
+        ("jobs", "GET", "/v1/jobs",
+            lambda i: ("/v1/jobs", None)),
+        ("job", "GET", "/v1/jobs/:job_id",
+            lambda i: ("/v1/jobs/unknown", None)),
+        ("events", "GET", "/v1/events",
+            lambda i: ("/v1/events?since=0&timeout=0", None)),
+        ("templates", "GET", "/v1/templates",
+            lambda i: ("/v1/templates", None)),
+        ("templates cache", "GET", "/v1/templates/cache",
+            lambda i: ("/v1/templates/cache", None)),
+        ("templates warm", "POST", "/v1/templates/cache",
+            lambda i: ("/v1/templates/cache", {"name": "ubuntu", "args": []})),
+        ("metrics", "GET", "/v1/metrics",
+            lambda i: ("/v1/metrics", None)),
+        ("swagger", "GET", "/v1/api-docs.json",
+            lambda i: ("/v1/api-docs.json", None)),
+        ("swagger containers", "GET", "/v1/api-docs.json/containers",
+            lambda i: ("/v1/api-docs.json/containers", None)),
+        ("destroy", "POST", "/v1/containers/:name/actions/destroy",
+            lambda i: ("/v1/containers/clone-%06d/actions/destroy" % i, {})),
+        ("delete", "DELETE", "/v1/containers/:name",
+            lambda i: ("/v1/containers/bench-%06d" % i, None)),
+        ("templates purge", "DELETE", "/v1/templates/cache",
+            lambda i: ("/v1/templates/cache", None)),
+    ]
+
+
+def serve(port, workers):
+    options = lxc_restapi.server_options('threaded', workers)
+    thread = threading.Thread(target=bottle.run,
+                              kwargs=dict(host="127.0.0.1", port=port, quiet=True, **options))
+    thread.daemon = True
+    thread.start()
+    url = "http://127.0.0.1:%s" % port
+    for i in range(50):
+        try:
+            urllib.request.urlopen(url + "/v1/jobs").read()
+            return url
+        except IOError:
+            time.sleep(0.1)
+    raise Exception("server did not start")
+
+
+def send(url, method, path, body):
+    """ returns the http status """
+    data = None
+    headers = {'Accept': 'application/json'}
+    if body is not None:
+        data = json.dumps(body).encode('utf-8')
+        headers['Content-type'] = 'application/json'
+    request = urllib.request.Request(url + path, data=data, headers=headers, method=method)
+    try:
+        with urllib.request.urlopen(request) as response:
+            response.read()
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def percentile(values, ratio):
+    return values[int(ratio * (len(values) - 1))]
+
+
+def run_scenario(url, method, factory, requests, concurrency):
+    """ (requests per second, latencies sorted, errors, 429s) """
+    counter = itertools.count()
+    latencies = []
+    errors = [0, 0]
+    lock = threading.Lock()
+
+    def client():
+        while True:
+            i = next(counter)
+            if i >= requests:
+                return
+            path, body = factory(i)
+            started = time.time()
+            status = send(url, method, path, body)
+            elapsed = time.time() - started
+            with lock:
+                latencies.append(elapsed)
+                if status >= 500:
+                    errors[0] += 1
+                elif status == 429:
+                    errors[1] += 1
+
+    started = time.time()
+    threads = [threading.Thread(target=client) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return requests / (time.time() - started), sorted(latencies), errors[0], errors[1]
+
+
+def wait_jobs(url, timeout=60):
+    """ let the queued jobs finish between scenarios """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        with urllib.request.urlopen(url + "/v1/jobs") as response:
+            jobs = json.loads(response.read().decode('utf-8'))['jobs']
+        if all(job['status'] in ('done', 'failed') for job in jobs):
+            return
+        time.sleep(0.05)
+
+
+def main(args):
+    latencies = {}
+    for item in args.latencies.split(','):
+        if '=' in item:
+            latencies[item.split('=')[0].strip()] = float(item.split('=')[1])
+    lxc.configure(containers=args.containers, latency=args.latency, latencies=latencies)
+    names = lxc.list_containers()
+    #every job of a scenario is queued, the later ones depend on them
+    lxc_restapi.ACTION_QUEUE_SIZE = max(lxc_restapi.ACTION_QUEUE_SIZE, args.requests)
+    if args.index:
+        lxc_restapi.open_index(args.index)
+    url = serve(args.port, args.workers)
+
+    covered = set()
+    print("%-20s %8s %6s %6s %10s %9s %9s" % ("scenario", "requests", "errors", "429", "req/s", "p50 ms", "p99 ms"))
+    for name, method, rule, factory in scenarios(names):
+        covered.add((method, rule))
+        if not any(fnmatch.fnmatch(name, pattern) for pattern in args.scenarios):
+            continue
+        rate, values, errors, limited = run_scenario(url, method, factory, args.requests, args.concurrency)
+        print("%-20s %8d %6d %6d %10.1f %9.2f %9.2f" % (
+                    name, len(values), errors, limited, rate,
+                    percentile(values, 0.5) * 1000, percentile(values, 0.99) * 1000))
+        wait_jobs(url)
+
+    for route in bottle.default_app().routes:
+        if (route.method, route.rule) not in covered and route.rule.startswith('/v1') \
+                and route.rule not in SKIPPED_ROUTES:
+            print("not benchmarked: %s %s" % (route.method, route.rule))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Lxc Restful benchmark with a fake lxc.')
+    parser.add_argument('--containers',
+                        type=int,
+                        help='simulated containers (default: 100)',
+                        default=100)
+    parser.add_argument('--latency',
+                        type=float,
+                        help='seconds of each liblxc call (default: 0.001)',
+                        default=0.001)
+    parser.add_argument('--latencies',
+                        help='seconds per liblxc call, e.g. create=2,start=0.5,get_ips=0.05',
+                        default='')
+    parser.add_argument('--requests',
+                        type=int,
+                        help='requests per scenario (default: 200)',
+                        default=200)
+    parser.add_argument('--concurrency',
+                        type=int,
+                        help='concurrent clients (default: 8)',
+                        default=8)
+    parser.add_argument('--workers',
+                        type=int,
+                        help='server threads (default: 16)',
+                        default=16)
+    parser.add_argument('--port',
+                        type=int,
+                        help='tcp port to listen on (default: 18180)',
+                        default=18180)
+    parser.add_argument('--index',
+                        metavar='PATH',
+                        help='sqlite containers index of the server (default: none)')
+    parser.add_argument('--scenarios',
+                        nargs='+',
+                        help='globs of the scenarios to run (default: all)',
+                        default=['*'])
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark of the response encoding of a large containers listing
+
+Builds the listing of --containers containers of the fake lxc
+(tests/stub) with every detail, then reports for each installed json
+encoder and each content coding the payload size and the encode time.
+"""
+
+import argparse
+import os
+import sys
+import time
+import zlib
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT, "tests", "stub"), ROOT]
+
+import lxc
+import lxc_restapi
+
+
+def listing(containers):
+    """ body of /v1/containers?detail=ips,conf_hash,actions, half running """
+    lxc.configure(containers=containers, latency=0)
+    for name in lxc.list_containers()[::2]:
+        lxc.Container(name).start()
+    snapshot = lxc_restapi.get_snapshot(fresh=True)
+    return {'containers': lxc_restapi.listing_details(snapshot['containers'], lxc_restapi.LISTING_DETAILS, snapshot),
+            'snapshot_age': 0}
+
+
+def timed(func, repeat):
+    """ (result, best seconds of repeat calls) """
+    best = None
+    for i in range(repeat):
+        started = time.time()
+        result = func()
+        elapsed = time.time() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+def main(args):
+    data = listing(args.containers)
+    print("%-8s %-8s %10s %10s" % ("encoder", "coding", "bytes", "ms"))
+    for name in lxc_restapi.JSON_ENCODERS:
+        dumps = lxc_restapi.json_encoder(name)
+        if dumps is None:
+            print("%-8s not installed" % name)
+            continue
+        body, seconds = timed(lambda: dumps(data).encode('utf-8'), args.repeat)
+        print("%-8s %-8s %10d %10.2f" % (name, "identity", len(body), seconds * 1000))
+        for coding, wbits in (("gzip", 31), ("deflate", 15)):
+            def encode():
+                compressor = zlib.compressobj(lxc_restapi.COMPRESS_LEVEL, zlib.DEFLATED, wbits)
+                return compressor.compress(dumps(data).encode('utf-8')) + compressor.flush()
+            compressed, seconds = timed(encode, args.repeat)
+            print("%-8s %-8s %10d %10.2f" % (name, coding, len(compressed), seconds * 1000))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Lxc Restful response encoding benchmark.')
+    parser.add_argument('--containers',
+                        type=int,
+                        help='containers in the listing (default: 1000)',
+                        default=1000)
+    parser.add_argument('--repeat',
+                        type=int,
+                        help='encodings of each kind, the best one is reported (default: 20)',
+                        default=20)
+    args = parser.parse_args()
+    main(args)
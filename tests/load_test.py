@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+"""
+Load test of GET /v1/containers against the lxc stub (tests/stub)
+
+the states snapshot hides the lxc calls, use --path "/v1/containers?fresh=1"
+to measure them
+
+Runs lxc_restapi with each server backend in a thread, hammers the
+listing from concurrent clients and prints the throughput
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT, "tests", "stub"), ROOT]
+
+from bottle import run
+import lxc_restapi
+
+
+def serve(server, port, workers, path):
+    options = lxc_restapi.server_options(server, workers)
+    options['debug'] = False
+    thread = threading.Thread(target=run,
+                              kwargs=dict(host="127.0.0.1", port=port, quiet=True, **options))
+    thread.daemon = True
+    thread.start()
+    url = "http://127.0.0.1:%s%s" % (port, path)
+    for i in range(50):
+        try:
+            urllib.request.urlopen(url).read()
+            return url
+        except IOError:
+            time.sleep(0.1)
+    raise Exception("%s server did not start" % server)
+
+
+def hammer(url, clients, duration):
+    """ returns number of requests per second """
+    count = [0] * clients
+    deadline = time.time() + duration
+
+    def client(i):
+        while time.time() < deadline:
+            urllib.request.urlopen(url).read()
+            count[i] += 1
+
+    threads = [threading.Thread(target=client, args=(i, )) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(count) / duration
+
+
+def main(args):
+    results = {}
+    for i, server in enumerate(args.servers):
+        url = serve(server, args.port + i, args.workers, args.path)
+        results[server] = hammer(url, args.clients, args.duration)
+        print("%-10s %8.1f req/s" % (server, results[server]))
+    if 'wsgiref' in results:
+        for server, rate in results.items():
+            print("%-10s x%.1f" % (server, rate / results['wsgiref']))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Lxc Restful load test.')
+    parser.add_argument('--servers',
+                        nargs='+',
+                        help='server backends to compare (default: wsgiref threaded)',
+                        default=['wsgiref', 'threaded'])
+    parser.add_argument('--path',
+                        help='url to request (default: /v1/containers)',
+                        default='/v1/containers')
+    parser.add_argument('--port',
+                        type=int,
+                        help='first tcp port to listen on (default: 18080)',
+                        default=18080)
+    parser.add_argument('--workers',
+                        type=int,
+                        help='server threads (default: 16)',
+                        default=16)
+    parser.add_argument('--clients',
+                        type=int,
+                        help='concurrent clients (default: 16)',
+                        default=16)
+    parser.add_argument('--duration',
+                        type=float,
+                        help='seconds per backend (default: 5)',
+                        default=5)
+    args = parser.parse_args()
+    main(args)
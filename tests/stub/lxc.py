@@ -0,0 +1,179 @@
+"""
+Stub of lxc's python api for tests and benchmarks without lxc
+
+Simulates STUB_CONTAINERS stopped containers. Every liblxc call or
+property read sleeps like a call to liblxc: STUB_LATENCY seconds, or
+the latency of the call given in STUB_LATENCIES, e.g.
+STUB_LATENCIES="create=2,start=0.5,wait=0.1,get_ips=0.05"
+
+In process, use configure() instead of the environment.
+"""
+import os
+import threading
+import time
+import zlib
+
+version = "1.0.0"
+
+LXC_CLONE_SNAPSHOT = 2
+
+STUB_CONTAINERS = int(os.environ.get('STUB_CONTAINERS', 50))
+STUB_LATENCY = float(os.environ.get('STUB_LATENCY', 0.001))
+
+LATENCIES = {}
+for item in os.environ.get('STUB_LATENCIES', '').split(','):
+    if '=' in item:
+        LATENCIES[item.split('=')[0].strip()] = float(item.split('=')[1])
+
+STATES = {}
+STATES_LOCK = threading.Lock()
+
+
+def configure(containers=None, latency=None, latencies=None):
+    """ Reset the stub with containers stopped containers and latencies """
+    global STUB_CONTAINERS, STUB_LATENCY
+    if containers is not None:
+        STUB_CONTAINERS = containers
+    if latency is not None:
+        STUB_LATENCY = latency
+    if latencies is not None:
+        LATENCIES.clear()
+        LATENCIES.update(latencies)
+    with STATES_LOCK:
+        STATES.clear()
+        STATES.update(("stub-%03d" % i, "STOPPED") for i in range(STUB_CONTAINERS))
+
+configure()
+
+
+def delay(call):
+    time.sleep(LATENCIES.get(call, STUB_LATENCY))
+
+
+def list_containers():
+    delay('list_containers')
+    with STATES_LOCK:
+        return sorted(STATES)
+
+
+class Container(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.conf = {"lxc.utsname": name,
+                     "lxc.rootfs": "/var/lib/lxc/%s/rootfs" % name,
+                     "lxc.tty": 4,
+                     "lxc.cap.drop": ["sys_module", "mac_admin"],
+                     "lxc.network.0.type": "veth",
+                     "lxc.network.0.link": "lxcbr0",
+                     "lxc.network.0.hwaddr": "00:16:3e:%02x:%02x:%02x" % (
+                                self.id() >> 16 & 0xff, self.id() >> 8 & 0xff, self.id() & 0xff)}
+        self.cgroups = {"memory.limit_in_bytes": "536870912",
+                        "cpu.shares": "1024"}
+
+    def id(self):
+        """ stable number derived from the name, for mac and ip """
+        return zlib.crc32(self.name.encode('utf-8'))
+
+    @property
+    def state(self):
+        delay('state')
+        return STATES.get(self.name, "STOPPED")
+
+    @property
+    def init_pid(self):
+        delay('init_pid')
+        #the server itself, so that its cgroup files can be read
+        return os.getpid() if STATES.get(self.name) == "RUNNING" else -1
+
+    @property
+    def running(self):
+        return STATES.get(self.name) == "RUNNING"
+
+    @property
+    def defined(self):
+        return self.name in STATES
+
+    def set_state(self, call, state):
+        delay(call)
+        with STATES_LOCK:
+            STATES[self.name] = state
+        return True
+
+    def create(self, template, args=None):
+        return self.set_state('create', "STOPPED")
+
+    def clone(self, newname, config_path=None, flags=0, bdevtype=None,
+              bdevdata=None, newsize=0, hookargs=()):
+        delay('clone')
+        with STATES_LOCK:
+            if newname in STATES:
+                return False
+            STATES[newname] = "STOPPED"
+        return Container(newname)
+
+    def start(self, *args, **kwargs):
+        return self.set_state('start', "RUNNING")
+
+    def stop(self):
+        return self.set_state('stop', "STOPPED")
+
+    def shutdown(self, timeout=-1):
+        return self.set_state('shutdown', "STOPPED")
+
+    def freeze(self):
+        return self.set_state('freeze', "FROZEN")
+
+    def unfreeze(self):
+        return self.set_state('unfreeze', "RUNNING")
+
+    def destroy(self):
+        delay('destroy')
+        with STATES_LOCK:
+            return STATES.pop(self.name, None) is not None
+
+    def wait(self, state, timeout=-1):
+        delay('wait')
+        return STATES.get(self.name) == state
+
+    def get_keys(self, key=None):
+        delay('get_keys')
+        return list(self.conf)
+
+    def get_config_item(self, key):
+        delay('get_config_item')
+        return self.conf[key]
+
+    def set_config_item(self, key, value):
+        delay('set_config_item')
+        self.conf[key] = value
+        return True
+
+    def clear_config_item(self, key):
+        delay('clear_config_item')
+        self.conf.pop(key, None)
+        return True
+
+    def save_config(self, path=None):
+        delay('save_config')
+        return True
+
+    def get_config_path(self):
+        return "/var/lib/lxc"
+
+    @property
+    def config_file_name(self):
+        return "/var/lib/lxc/%s/config" % self.name
+
+    def get_cgroup_item(self, key):
+        delay('get_cgroup_item')
+        return self.cgroups[key]
+
+    def set_cgroup_item(self, key, value):
+        delay('set_cgroup_item')
+        self.cgroups[key] = value
+        return True
+
+    def get_ips(self, *args, **kwargs):
+        delay('get_ips')
+        return ["10.0.3.%d" % (self.id() % 250 + 2)] if STATES.get(self.name) == "RUNNING" else []
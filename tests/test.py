@@ -11,6 +11,7 @@ import uuid, time
 import requests
 
 API_ROOT = "http://localhost:8080/v1"
+SERVER_ROOT = "http://localhost:8080"
 
 def keyval_list_to_dict(data):
     retval = {}
@@ -64,6 +65,17 @@ def delete(url):
     r = requests.delete(API_ROOT + url, headers=headers)
     return r  
 
+def wait_job(r, timeout=600):
+    """ follow the job of a 202 response until it is finished """
+    assert(r.status_code == 202)
+    job = r.json()
+    while job['status'] in ('queued', 'running') and timeout > 0:
+        time.sleep(1)
+        timeout -= 1
+        job = get("/jobs/%s" % job['id']).json()
+    assert(job['status'] == "done")
+    return job
+
 def main(args):
     # Some constants
     LXC_TEMPLATE = "ubuntu"
@@ -84,7 +96,7 @@ def main(args):
         "args": [],
         "name": LXC_TEMPLATE }})
     
-    result = r.json()
+    result = wait_job(r)['result']
     
     assert(result['init_pid'] == -1)
     assert(result['name'] == CONTAINER_NAME)
@@ -101,7 +113,48 @@ def main(args):
     
     container =  search_in_list_of_dict(list_containers['containers'], "name", CONTAINER_NAME)
     assert(CONTAINER_NAME == container['name'])
-    
+
+    ## Testing the response encodings
+    print("Testing the response encodings")
+    for coding in ("gzip", "deflate", "identity"):
+        r = requests.get(API_ROOT + "/api-docs.json/containers", headers={'Accept-Encoding': coding})
+        assert(r.status_code == 200)
+        assert(r.headers['Vary'] == "Accept-Encoding")
+        assert(r.headers.get('Content-Encoding') == (None if coding == "identity" else coding))
+        assert(r.headers['ETag'].startswith("W/") == (coding != "identity"))
+        assert(len(r.json()['apis']) > 0)
+
+    for doc in ("/api-docs.json", "/api-docs.json/containers"):
+        r = requests.get(API_ROOT + doc, headers={'Accept-Encoding': "gzip"})
+        r = requests.get(API_ROOT + doc,
+                         headers={'Accept-Encoding': "gzip", 'If-None-Match': r.headers['ETag']})
+        assert(r.status_code == 304)
+        assert(r.headers['Vary'] == "Accept-Encoding")
+
+    r = requests.get(SERVER_ROOT + "/info")
+    assert(r.status_code == 200)
+    r = requests.get(SERVER_ROOT + "/info",
+                     headers={'If-None-Match': r.headers.get('ETag', ''),
+                              'If-Modified-Since': r.headers['Last-Modified']})
+    assert(r.status_code == 304)
+
+    ## Testing the events long-poll
+    print("Testing the events")
+    r = requests.get(API_ROOT + "/events", headers={'Accept': "text/event-stream"}, stream=True)
+    single_threaded = r.status_code == 406
+    if not single_threaded:
+        assert(r.status_code == 200)
+        assert(r.headers['Content-Type'].startswith("text/event-stream"))
+    r.close()
+    started = time.time()
+    r = get("/events?timeout=%s" % (30 if single_threaded else 1))
+    assert(r.status_code == 200)
+    if single_threaded:
+        #one request at a time: the long-poll must not hold the server
+        assert(time.time() - started < 10)
+    r = get("/events?timeout=abc")
+    assert(r.status_code == 400)
+
     """
     ## Test the config modification
     #@TODO implement this
@@ -146,11 +199,10 @@ def main(args):
     ## Starting the container
     print("Starting the container")
     r = post("/containers/%s/actions/start" % (CONTAINER_NAME), {})
-    assert(r.status_code == 200)
-    #@TODO implement this
-    #container.wait("RUNNING", 3)
+    wait_job(r)
+    r = get("/containers/%s/wait?state=RUNNING&timeout=10" % (CONTAINER_NAME))
+    assert(r.json()['reached'])
     
-    time.sleep(5)
     r = get("/containers/%s" % (CONTAINER_NAME))
     assert(r.status_code == 200)
     container = r.json()
@@ -159,32 +211,43 @@ def main(args):
     #@TODO this too
     #assert(container.running)
     
-    """
     ## Checking IP address
     print("Getting the IP addresses")
-    
-    count = 0
-    ips = []
-    while not ips or count == 10:
-        ips = container.get_ips()
-        time.sleep(1)
-        count += 1
-    container.attach("NETWORK|UTSNAME", "/sbin/ifconfig", "eth0")
+    r = get("/containers/%s/wait?state=RUNNING&ips=1&timeout=60" % (CONTAINER_NAME))
+    assert(r.status_code == 200)
+    ips = r.json()['ips']
     
     # A few basic checks of the current state
     assert(len(ips) > 0)
     
+    """
+    #@TODO implement this
+    container.attach("NETWORK|UTSNAME", "/sbin/ifconfig", "eth0")
+    """
+    
     ## Testing cgroups a bit
     print("Testing cgroup API")
-    max_mem = container.get_cgroup_item("memory.max_usage_in_bytes")
-    current_limit = container.get_cgroup_item("memory.limit_in_bytes")
-    assert(container.set_cgroup_item("memory.limit_in_bytes", max_mem))
-    assert(container.get_cgroup_item("memory.limit_in_bytes") != current_limit)
-    """
+    r = get("/containers/%s/cgroups?keys=memory.max_usage_in_bytes,memory.limit_in_bytes" % (CONTAINER_NAME))
+    assert(r.status_code == 200)
+    cgroups = dict((item['key'], item['value']) for item in r.json()['cgroups'])
+    max_mem = cgroups["memory.max_usage_in_bytes"]
+    current_limit = cgroups["memory.limit_in_bytes"]
+    r = put("/containers/%s/cgroups" % (CONTAINER_NAME),
+            {"cgroups": [{"key": "memory.limit_in_bytes", "val": max_mem}], "persist": False})
+    assert(r.status_code == 200)
+    cgroups = dict((item['key'], item['value']) for item in r.json()['cgroups'])
+    assert(cgroups["memory.limit_in_bytes"] != current_limit)
+    
+    r = get("/containers/%s/stats" % (CONTAINER_NAME))
+    assert(r.status_code == 200)
+    assert(r.json()['memory']['usage_bytes'] > 0)
+    r = get("/stats")
+    assert(r.status_code == 200)
+    assert(CONTAINER_NAME in [stats['name'] for stats in r.json()['stats']])
     ## Freezing the container
     print("Freezing the container")
     r = post("/containers/%s/actions/freeze" % (CONTAINER_NAME), {})
-    assert(r.status_code == 200)
+    wait_job(r)
     r = get("/containers/%s" % (CONTAINER_NAME))
     assert(r.status_code == 200)
     container = r.json()
@@ -194,7 +257,7 @@ def main(args):
     ## Unfreezing the container
     print("Unfreezing the container")
     r = post("/containers/%s/actions/unfreeze" % (CONTAINER_NAME), {})
-    assert(r.status_code == 200)
+    wait_job(r)
     r = get("/containers/%s" % (CONTAINER_NAME))
     assert(r.status_code == 200)
     container = r.json()
@@ -212,10 +275,10 @@ def main(args):
     ## Shutting down the container
     print("Shutting down the container")
     r = post("/containers/%s/actions/shutdown" % (CONTAINER_NAME), {})
-    assert(r.status_code == 200)
+    wait_job(r)
     
     r = post("/containers/%s/actions/stop" % (CONTAINER_NAME), {})
-    assert(r.status_code == 200)
+    wait_job(r)
     
     r = get("/containers/%s" % (CONTAINER_NAME))
     assert(r.status_code == 200)
@@ -224,16 +287,20 @@ def main(args):
     assert(container['init_pid'] == -1)
     
     
-    """ @TODO implement clonning 
     ## Cloning the container
     print("Cloning the container")
+    r = post("/containers/%s/actions/clone" % (CONTAINER_NAME), {"name": CLONE_NAME})
+    clone = wait_job(r)['result']
+    assert(clone['name'] == CLONE_NAME)
+    assert(clone['state'] == "STOPPED")
+    
+    r = post("/containers/%s/actions/start" % (CLONE_NAME), {})
+    wait_job(r)
+    r = post("/containers/%s/actions/stop" % (CLONE_NAME), {})
+    wait_job(r)
+    r = delete("/containers/%s" % (CLONE_NAME))
+    assert(r.status_code == 200)
     
-    clone = lxc.Container(CLONE_NAME)
-    clone.clone(container)
-    clone.start()
-    clone.stop()
-    clone.destroy()
-    """
     ## Destroy the container
     print("Destroying the container")
     r = delete("/containers/%s" % (CONTAINER_NAME))
@@ -258,5 +325,6 @@ if  __name__ == "__main__":
                         help='tcp port to connect to (default: 8080)',
                         default="8080")
     args = parser.parse_args()
-    API_ROOT = "http://%s:%s/v1" % (args.ip, args.port)   
+    SERVER_ROOT = "http://%s:%s" % (args.ip, args.port)
+    API_ROOT = SERVER_ROOT + "/v1"
     main(args)
\ No newline at end of file